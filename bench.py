@@ -0,0 +1,283 @@
+"""
+Benchmarks the booking endpoints against a seeded dataset.
+
+The app is driven in-process through the ASGI test client with authentication
+stubbed out, so only routing, handlers and storage are measured. For every route
+it reports latency percentiles, storage reads and documents read per request
+and throughput.
+
+    python bench.py --rooms 50 --days 14 --bookings-per-day 8
+    python bench.py --scale 1,10,100 --plot scaling.png
+
+The memory backend is used by default. With --backend firestore the dataset is
+written to the Firestore emulator, which FIRESTORE_EMULATOR_HOST must point at.
+The emulator's database is cleared before every dataset is seeded.
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import httpx
+from fastapi.testclient import TestClient
+
+import main
+from instrumentation import InstrumentedRepository, registry
+from storage import create_repository
+
+FIRST_DATE = date(2030, 1, 1)
+BENCH_USER = 'bench-user-0'
+
+
+def clear_emulator(repository):
+    # Every run seeds the same room names, which create_room refuses to create twice
+    url = (f"http://{os.environ['FIRESTORE_EMULATOR_HOST']}/emulator/v1/projects/{repository.client.project}"
+           f"/databases/(default)/documents")
+    httpx.delete(url).raise_for_status()
+
+
+def seed(repository, rooms, days, bookings_per_day, users):
+    """
+    Creates `rooms` rooms, each booked `bookings_per_day` times on each of `days`
+    days from FIRST_DATE, in half-hour slots from 08:00 spread over `users` users.
+    Returns the ids of the bookings created.
+    """
+    if bookings_per_day > 28:
+        raise ValueError("At most 28 half-hour bookings fit between 08:00 and 22:00")
+
+    bookings = []
+    for room_number in range(rooms):
+        room_name = f"room-{room_number:04d}"
+        repository.create_room(BENCH_USER, room_name)
+
+        for day in range(days):
+            for slot in range(bookings_per_day):
+                start = 8 * 60 + slot * 30
+                bookings.append({
+                    'id': main.generate_random_id(),
+                    'room_name': room_name,
+                    'date': (FIRST_DATE + timedelta(days=day)).isoformat(),
+                    'start_time': main.minutes_to_time(start),
+                    'end_time': main.minutes_to_time(start + 30),
+                    'booked_by': f"bench-user-{len(bookings) % users}"
+                })
+
+    # Write in chunks so a single import never gets too large
+    for position in range(0, len(bookings), 500):
+        errors = repository.create_bookings(bookings[position:position + 500])
+        if errors:
+            raise RuntimeError(f"Seeding failed: {errors[0]}")
+
+    return [booking['id'] for booking in bookings]
+
+
+def build_routes(rooms, days, booking_ids):
+    """
+    The benchmarked requests as (name, function of (client, iteration)) pairs.
+    Write routes use a fresh date or booking on every iteration so each request does real work.
+    """
+    seeded_date = FIRST_DATE.isoformat()
+    last_date = (FIRST_DATE + timedelta(days=days - 1)).isoformat()
+    free_date = FIRST_DATE + timedelta(days=days)
+    deletable = list(booking_ids)
+
+    def reserve(client, iteration):
+        response = client.post('/reserve-room', data={
+            'room_name': f"room-{iteration % rooms:04d}",
+            'date': (free_date + timedelta(days=iteration // rooms)).isoformat(),
+            'start_time': '09:00',
+            'end_time': '10:00'
+        })
+        # A taken slot is answered with a 200 page too, and would measure a conflict instead of a booking
+        if response.status_code == 200 and "Booking added successfully" not in response.text:
+            raise RuntimeError(f"Reservation {iteration} was not created")
+        return response
+
+    def delete(client, iteration):
+        # Each delete needs its own booking
+        if not deletable:
+            raise RuntimeError("Ran out of seeded bookings to delete; raise --days or --bookings-per-day")
+        return client.get(f"/delete/booking/{deletable.pop()}")
+
+    return [
+        ('GET /', lambda client, iteration: client.get('/')),
+        ('POST /show_bookings', lambda client, iteration: client.post('/show_bookings')),
+        ('GET /room-bookings/{room}', lambda client, iteration: client.get(f"/room-bookings/room-{iteration % rooms:04d}")),
+        ('GET /filter-date', lambda client, iteration: client.get('/filter-date', params={'date': seeded_date})),
+        ('GET /availability', lambda client, iteration: client.get('/availability', params={'date': seeded_date, 'duration': 30})),
+        ('GET /api/bookings', lambda client, iteration: client.get('/api/bookings')),
+        ('GET /api/bookings/by-date', lambda client, iteration: client.get('/api/bookings/by-date', params={'date': seeded_date})),
+        ('GET /api/bookings/range', lambda client, iteration: client.get('/api/bookings/range', params={'from': seeded_date, 'to': last_date})),
+        ('POST /reserve-room', reserve),
+        ('GET /delete/booking/{id}', delete),
+    ]
+
+
+def percentile(samples, fraction):
+    # Nearest-rank percentile of already sorted samples
+    position = max(0, min(len(samples) - 1, int(round(fraction * len(samples) + 0.5)) - 1))
+    return samples[position]
+
+
+def run_route(clients, request, requests, cold, first_iteration=0):
+    """
+    Sends `requests` requests spread over one thread per client, numbered from `first_iteration`.
+    Returns the sorted latencies in milliseconds, the elapsed seconds, and the storage
+    reads made and documents returned.
+    """
+    latencies = []
+    lock = threading.Lock()
+    next_iteration = iter(range(first_iteration, first_iteration + requests))
+
+    def worker(client):
+        while True:
+            with lock:
+                iteration = next(next_iteration, None)
+            if iteration is None:
+                return
+
+            if cold:
+                main.read_cache.invalidate()
+                main.fragment_cache.invalidate()
+
+            started = time.perf_counter()
+            response = request(client, iteration)
+            elapsed = (time.perf_counter() - started) * 1000
+
+            if response.status_code >= 400:
+                raise RuntimeError(f"{response.request.method} {response.request.url} answered {response.status_code}")
+            with lock:
+                latencies.append(elapsed)
+
+    reads_before, documents_before = registry.read_totals()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        for future in [executor.submit(worker, client) for client in clients]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    reads_after, documents_after = registry.read_totals()
+    return sorted(latencies), elapsed, reads_after - reads_before, documents_after - documents_before
+
+
+def run_benchmark(args, rooms):
+    """
+    Seeds a fresh dataset of `rooms` rooms and benchmarks every route against it.
+    Returns one result dict per route.
+    """
+    repository = create_repository(args.backend)
+    if args.backend == "firestore":
+        clear_emulator(repository)
+    booking_ids = seed(repository, rooms, args.days, args.bookings_per_day, args.users)
+
+    main.repository = InstrumentedRepository(repository)
+    main.read_cache.invalidate()
+
+    user_token = {'user_id': BENCH_USER}
+    main.app.dependency_overrides[main.get_user_token] = lambda: user_token
+    main.app.dependency_overrides[main.require_user_token] = lambda: user_token
+
+    clients = [TestClient(main.app, cookies={'token': 'bench'}) for _ in range(args.concurrency)]
+    routes = build_routes(rooms, args.days, booking_ids)
+    results = []
+    for name, request in routes:
+        if args.route and not any(pattern in name for pattern in args.route):
+            continue
+
+        # A few unmeasured requests first, so one-time setup does not skew the numbers. The
+        # measured ones carry on from there, so write routes do not repeat the warmup's requests.
+        run_route(clients[:1], request, args.warmup, args.cold)
+        latencies, elapsed, reads, documents = run_route(clients, request, args.requests, args.cold, first_iteration=args.warmup)
+
+        results.append({
+            'route': name,
+            'rooms': rooms,
+            'requests': len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'reads_per_request': reads / len(latencies),
+            'documents_per_request': documents / len(latencies),
+            'throughput': len(latencies) / elapsed
+        })
+
+    main.app.dependency_overrides.clear()
+    return results
+
+
+def print_table(results):
+    header = (f"{'route':<28} {'rooms':>6} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+              f"{'reads/req':>10} {'docs/req':>10} {'req/s':>9}")
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['route']:<28} {result['rooms']:>6} {result['requests']:>6} {result['p50']:>9.2f} {result['p95']:>9.2f} "
+              f"{result['p99']:>9.2f} {result['reads_per_request']:>10.2f} {result['documents_per_request']:>10.2f} "
+              f"{result['throughput']:>9.1f}")
+
+
+def plot_scaling(results, path):
+    # matplotlib is optional; without it the table printed above is the whole report
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, skipping the plot", file=sys.stderr)
+        return
+
+    routes = list(dict.fromkeys(result['route'] for result in results))
+    figure, (latency_axis, documents_axis) = plt.subplots(1, 2, figsize=(14, 6))
+    for route in routes:
+        points = [result for result in results if result['route'] == route]
+        sizes = [point['rooms'] for point in points]
+        latency_axis.plot(sizes, [point['p50'] for point in points], marker='o', label=route)
+        documents_axis.plot(sizes, [point['documents_per_request'] for point in points], marker='o', label=route)
+
+    for axis, label in ((latency_axis, 'p50 latency (ms)'), (documents_axis, 'documents read per request')):
+        axis.set_xscale('log')
+        axis.set_xlabel('rooms')
+        axis.set_ylabel(label)
+        axis.grid(True, alpha=0.3)
+    documents_axis.legend(fontsize='small')
+
+    figure.tight_layout()
+    figure.savefig(path)
+    print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the booking endpoints")
+    parser.add_argument("--backend", choices=["memory", "firestore"], default="memory")
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--bookings-per-day", type=int, default=4)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=1, help="clients sending requests at once")
+    parser.add_argument("--cold", action="store_true", help="clear the read cache before every request")
+    parser.add_argument("--route", action="append", help="only benchmark routes containing this text (repeatable)")
+    parser.add_argument("--scale", help="comma-separated room counts to benchmark one after another, e.g. 1,10,100")
+    parser.add_argument("--plot", help="with --scale, save a plot of cost against dataset size to this file")
+    args = parser.parse_args()
+
+    if args.backend == "firestore" and not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        parser.error("the firestore backend is only benchmarked against the emulator; set FIRESTORE_EMULATOR_HOST")
+
+    # Per-request logs would drown the report; slow requests are still logged
+    logging.getLogger('bookings').setLevel(logging.WARNING)
+
+    sizes = [int(size) for size in args.scale.split(",")] if args.scale else [args.rooms]
+
+    results = []
+    for rooms in sizes:
+        results.extend(run_benchmark(args, rooms))
+
+    print_table(results)
+    if args.plot:
+        plot_scaling(results, args.plot)
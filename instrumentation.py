@@ -0,0 +1,342 @@
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from functools import partial
+
+from local_constants import LOG_LEVEL, LOG_SAMPLE_RATE
+
+# Repository methods by the kind of storage operation they perform; anything else counts as a query.
+# Only used for backends that do not report their own storage calls.
+READ_OPERATIONS = {'get_dashboard', 'get_room', 'get_room_removal', 'get_booking', 'get_day_intervals', 'ensure_user'}
+WRITE_OPERATIONS = {'create_room', 'delete_room', 'start_room_removal', 'remove_room', 'create_booking', 'create_bookings',
+                    'write_bookings', 'update_booking', 'delete_booking', 'backfill_booking_projections',
+                    'migrate_booking_timestamps'}
+
+# Firestore API methods by the kind of storage call they are, and for streamed responses
+# the response field that carries a returned document. Other methods are not counted.
+FIRESTORE_CALLS = {
+    'batch_get_documents': ('read', 'found'),
+    'run_query': ('query', 'document'),
+    'run_aggregation_query': ('query', None),
+    'list_documents': ('query', None),
+    'list_collection_ids': ('query', None),
+    'commit': ('write', None),
+    'batch_write': ('write', None)
+}
+FIRESTORE_STREAMING_CALLS = {'batch_get_documents', 'run_query', 'run_aggregation_query'}
+
+# Upper bounds, in seconds, of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats:
+    """
+    Storage use of one request: how many reads, writes and queries it sent to the
+    backend, the documents they returned, and the time spent per repository method.
+    Shared with the worker threads the request uses, hence the lock.
+    """
+
+    def __init__(self):
+        self.counts = {'read': 0, 'write': 0, 'query': 0}
+        self.documents = 0
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, kind, documents):
+        with self._lock:
+            self.counts[kind] += 1
+            self.documents += documents
+
+    def record_timing(self, operation, seconds):
+        with self._lock:
+            self.timings[operation] = self.timings.get(operation, 0.0) + seconds
+
+    def storage_seconds(self):
+        with self._lock:
+            return sum(self.timings.values())
+
+    def server_timing(self, total_seconds):
+        # Server-Timing header value: the whole request, storage in total, then each repository method
+        with self._lock:
+            entries = [f"app;dur={total_seconds * 1000:.1f}",
+                       f'storage;dur={sum(self.timings.values()) * 1000:.1f};desc="{self.counts["read"]} reads, '
+                       f'{self.counts["write"]} writes, {self.counts["query"]} queries, {self.documents} docs"']
+            entries.extend(f"{operation};dur={seconds * 1000:.1f}" for operation, seconds in self.timings.items())
+        return ", ".join(entries)
+
+
+# The stats of the request being handled; anyio worker threads inherit it
+current_stats = contextvars.ContextVar('current_stats', default=None)
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters exposed on /metrics in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.request_buckets = {}
+        self.request_seconds = {}
+        self.operations = {}
+        self.operation_seconds = {}
+        self.calls = {}
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def observe_request(self, method, route, status_code, seconds):
+        labels = (method, route, str(status_code))
+        with self._lock:
+            self.requests[labels] = self.requests.get(labels, 0) + 1
+            self.request_seconds[(method, route)] = self.request_seconds.get((method, route), 0.0) + seconds
+            buckets = self.request_buckets.setdefault((method, route), [0] * len(DURATION_BUCKETS))
+            for position, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    buckets[position] += 1
+
+    def observe_operation(self, operation, seconds):
+        with self._lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+            self.operation_seconds[operation] = self.operation_seconds.get(operation, 0.0) + seconds
+
+    def observe_call(self, kind, method, documents):
+        with self._lock:
+            self.calls[(kind, method)] = self.calls.get((kind, method), 0) + 1
+            self.documents += documents
+
+    def read_totals(self):
+        # Read calls made and documents returned so far, to measure a stretch of work by difference
+        with self._lock:
+            return sum(count for (kind, _), count in self.calls.items() if kind == 'read'), self.documents
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP bookings_http_requests_total HTTP requests handled.",
+                     "# TYPE bookings_http_requests_total counter"]
+            for (method, route, status_code), count in sorted(self.requests.items()):
+                lines.append(f'bookings_http_requests_total{{method="{method}",route="{route}",status="{status_code}"}} {count}')
+
+            lines += ["# HELP bookings_http_request_duration_seconds Time spent handling HTTP requests.",
+                      "# TYPE bookings_http_request_duration_seconds histogram"]
+            for (method, route), buckets in sorted(self.request_buckets.items()):
+                labels = f'method="{method}",route="{route}"'
+                for bound, count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'bookings_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                total = sum(count for (m, r, _), count in self.requests.items() if (m, r) == (method, route))
+                lines.append(f'bookings_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {total}')
+                lines.append(f'bookings_http_request_duration_seconds_sum{{{labels}}} {self.request_seconds[(method, route)]:.6f}')
+                lines.append(f'bookings_http_request_duration_seconds_count{{{labels}}} {total}')
+
+            lines += ["# HELP bookings_storage_operations_total Repository method calls.",
+                      "# TYPE bookings_storage_operations_total counter"]
+            for operation, count in sorted(self.operations.items()):
+                lines.append(f'bookings_storage_operations_total{{operation="{operation}"}} {count}')
+
+            lines += ["# HELP bookings_storage_operation_seconds_total Time spent in repository methods.",
+                      "# TYPE bookings_storage_operation_seconds_total counter"]
+            for operation, seconds in sorted(self.operation_seconds.items()):
+                lines.append(f'bookings_storage_operation_seconds_total{{operation="{operation}"}} {seconds:.6f}')
+
+            lines += ["# HELP bookings_storage_calls_total Reads, writes and queries sent to the storage backend, by backend method.",
+                      "# TYPE bookings_storage_calls_total counter"]
+            for (kind, method), count in sorted(self.calls.items()):
+                lines.append(f'bookings_storage_calls_total{{kind="{kind}",method="{method}"}} {count}')
+
+            lines += ["# HELP bookings_storage_documents_total Documents returned by storage calls.",
+                      "# TYPE bookings_storage_documents_total counter",
+                      f"bookings_storage_documents_total {self.documents}"]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def record_operation(operation, seconds):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.record_timing(operation, seconds)
+    registry.observe_operation(operation, seconds)
+
+
+def record_call(kind, method, documents, stats=None):
+    # `stats` is the request's, captured when the call was made, for responses consumed later
+    stats = stats or current_stats.get()
+    if stats is not None:
+        stats.record_call(kind, documents)
+    registry.observe_call(kind, method, documents)
+
+
+def count_documents(result):
+    # Documents a repository call returned: one per row of a list, one for a single record
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple):
+        return 1 if result and result[0] is not None else 0
+    if isinstance(result, dict) or result is True:
+        return 1
+    return 0
+
+
+class InstrumentedRepository:
+    """
+    Wraps a repository so every public method call is timed against the current
+    request and the process-wide metrics. Listings are timed until they are
+    exhausted, so streamed responses are accounted for too.
+
+    Backends that report their own storage calls (see InstrumentedFirestoreAPI) are
+    counted there; for the others each method call counts as one storage call.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.counts_calls = not getattr(repository, 'reports_storage_calls', False)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repository, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        if not self.counts_calls:
+            kind = None
+        elif name in READ_OPERATIONS:
+            kind = 'read'
+        elif name in WRITE_OPERATIONS:
+            kind = 'write'
+        else:
+            kind = 'query'
+
+        if name.startswith('iter_'):
+            return partial(self._iterate, kind, name, attribute)
+        return partial(self._call, kind, name, attribute)
+
+    @staticmethod
+    def _call(kind, operation, method, *args, **kwargs):
+        started = time.perf_counter()
+        documents = 0
+        try:
+            result = method(*args, **kwargs)
+            documents = count_documents(result)
+            return result
+        finally:
+            record_operation(operation, time.perf_counter() - started)
+            if kind is not None:
+                record_call(kind, operation, documents)
+
+    @staticmethod
+    def _iterate(kind, operation, method, *args, **kwargs):
+        started = time.perf_counter()
+        rows = method(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        def timed_rows():
+            nonlocal elapsed
+            documents = 0
+            try:
+                while True:
+                    resumed = time.perf_counter()
+                    try:
+                        row = next(rows)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - resumed
+                    documents += 1
+                    yield row
+            finally:
+                record_operation(operation, elapsed)
+                if kind is not None:
+                    record_call(kind, operation, documents)
+
+        return timed_rows()
+
+
+class InstrumentedFirestoreAPI:
+    """
+    Wraps the API layer of a Firestore client, so every request the client sends
+    is counted as a read, write or query with the documents it returns. A
+    repository method that fans out over rooms counts one query per room.
+    """
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attribute = getattr(self._api, name)
+        if name not in FIRESTORE_CALLS:
+            return attribute
+        if name in FIRESTORE_STREAMING_CALLS:
+            return partial(self._stream, name, attribute)
+        return partial(self._call, name, attribute)
+
+    @staticmethod
+    def _call(name, method, *args, **kwargs):
+        result = method(*args, **kwargs)
+        record_call(FIRESTORE_CALLS[name][0], name, 0)
+        return result
+
+    @staticmethod
+    def _stream(name, method, *args, **kwargs):
+        kind, document_field = FIRESTORE_CALLS[name]
+        stats = current_stats.get()
+        responses = method(*args, **kwargs)
+
+        def counted_responses():
+            documents = 0
+            try:
+                for response in responses:
+                    if document_field and document_field in response:
+                        documents += 1
+                    yield response
+            finally:
+                record_call(kind, name, documents, stats)
+
+        return counted_responses()
+
+
+def instrument_firestore_client(client):
+    # Swap the client's lazily built API object for a counting wrapper
+    client._firestore_api_internal = InstrumentedFirestoreAPI(client._firestore_api)
+    return client
+
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line: time, level, logger, event and the record's fields
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a `rate` share of DEBUG and INFO records; warnings and errors always pass
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+logger = logging.getLogger('bookings')
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter())
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def log_event(level, event, **fields):
+    # Structured log line; the fields are only formatted if the record is actually emitted
+    logger.log(level, event, extra={'fields': fields})
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import threading
+
+
+class Subscriber:
+    """
+    One connected browser: a filter over change events and the asyncio queue its
+    event stream reads from. Events arrive on the listener's thread and are handed
+    to the subscriber's event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, loop, matches, queue_size):
+        self.loop = loop
+        self.matches = matches
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def offer(self, event, previous):
+        # A booking moving out of the subscriber's view still concerns it
+        kind = event['type'].split('_')[0]
+        if self.matches(kind, event['data']) or (previous is not None and self.matches(kind, previous)):
+            self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        # A browser that stops reading loses its oldest events instead of growing the queue
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+
+class LiveHub:
+    """
+    A single storage listener shared by every connected browser.
+
+    It keeps a live in-memory view of all rooms and bookings, built from the
+    repository's change events ('room_added', 'booking_removed', ...), and passes
+    each change on to the subscribers whose filter it matches. The listener is
+    started by the first subscriber and then stays up.
+    """
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.rooms = {}
+        self.bookings = {}
+        self.subscribers = set()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self, repository):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        # Some backends replay their current contents synchronously, so watch outside the lock
+        repository.watch(self.apply)
+
+    def apply(self, event):
+        # Called on the listener's thread for every change
+        data = event['data']
+        previous = None
+
+        with self._lock:
+            if event['type'].startswith('room_'):
+                if event['type'] == 'room_removed':
+                    self.rooms.pop(data['name'], None)
+                else:
+                    self.rooms[data['name']] = data
+            else:
+                previous = self.bookings.get(data['id'])
+                if event['type'] == 'booking_removed':
+                    # A moved booking can be re-added under a new document before the old one is removed
+                    if previous != data:
+                        return
+                    del self.bookings[data['id']]
+                    previous = None
+                else:
+                    self.bookings[data['id']] = data
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            subscriber.offer(event, previous)
+
+    def subscribe(self, matches):
+        """
+        Registers a subscriber on the running event loop.
+        Returns it with the bookings of the live view it matches, so the stream can
+        start from a snapshot and continue with changes.
+        """
+        subscriber = Subscriber(asyncio.get_running_loop(), matches, self.queue_size)
+        with self._lock:
+            self.subscribers.add(subscriber)
+            snapshot = [booking for booking in self.bookings.values() if matches('booking', booking)]
+        snapshot.sort(key=lambda booking: (booking.get('date', ''), booking.get('start_time', ''), booking['id']))
+        return subscriber, snapshot
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+
+def sse_message(event, data):
+    # One server-sent event; the payload is a single line of JSON with ISO 8601 timestamps
+    payload = json.dumps(data, default=lambda value: value.isoformat())
+    return f"event: {event}\ndata: {payload}\n\n"
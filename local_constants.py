@@ -1 +1,69 @@
+# Number of bookings shown per page on /show_bookings
+BOOKINGS_PAGE_SIZE = 20
 
+# In-process cache for the room list and booked dates
+READ_CACHE_TTL_SECONDS = 30
+READ_CACHE_MAX_ENTRIES = 128
+
+# Rendered room lists kept, one per dashboard version and user
+FRAGMENT_CACHE_MAX_ENTRIES = 1024
+
+# Blocking Firestore and auth calls allowed in flight at once per worker
+FIRESTORE_MAX_CONCURRENCY = 32
+
+# Documents the landing page's booking counts are spread over, so bookings do not all write one document
+DASHBOARD_COUNTER_SHARDS = 10
+
+# Firebase project used as the expected token audience (None skips the audience check)
+FIREBASE_PROJECT_ID = None
+
+# Verified ID tokens remembered until they expire
+VERIFIED_TOKEN_CACHE_SIZE = 1024
+
+# Shortest time between fetches of Google's keys forced by tokens with an unknown key id
+CERTS_REFRESH_INTERVAL_SECONDS = 60
+
+# Largest page the /api listings return in JSON mode
+API_MAX_PAGE_SIZE = 200
+
+# Rows an NDJSON stream pulls from its listing at a time, and the memory backend copies out per lock
+LISTING_BATCH_SIZE = 100
+
+# Largest number of bookings a single bulk import or recurrence may create
+BULK_MAX_BOOKINGS = 5000
+
+# Storage backend: "firestore" or "memory" (overridden by the BOOKINGS_STORAGE_BACKEND environment variable)
+STORAGE_BACKEND = "firestore"
+
+# Google Cloud project of the Firestore client (None uses the environment's default; GOOGLE_CLOUD_PROJECT overrides it)
+FIRESTORE_PROJECT = None
+
+# Level of the structured logs, and the share of DEBUG/INFO records kept (warnings and errors are always kept)
+LOG_LEVEL = "INFO"
+LOG_SAMPLE_RATE = 0.1
+
+# Requests slower than this are always logged as warnings
+SLOW_REQUEST_SECONDS = 1.0
+
+# User profiles remembered after their first read
+KNOWN_USER_CACHE_SIZE = 4096
+KNOWN_USER_TTL_SECONDS = 3600
+
+# Change events buffered per live-update stream before the oldest are dropped
+LIVE_QUEUE_SIZE = 256
+
+# Seconds between keepalive comments on idle live-update streams
+LIVE_KEEPALIVE_SECONDS = 15
+
+# Background jobs (room removals) remembered per worker for /jobs/{job_id}, and for how many seconds
+JOB_HISTORY_SIZE = 100
+JOB_TTL_SECONDS = 86400
+
+# Seconds a room removal holds its lease without renewing it; another run may take over after that
+ROOM_REMOVAL_LEASE_SECONDS = 300
+
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESS_MINIMUM_SIZE = 500
+
+# How long browsers keep fingerprinted static files (one year)
+STATIC_MAX_AGE_SECONDS = 31536000
@@ -1,81 +1,345 @@
-from fastapi import FastAPI, Request, HTTPException, Form, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request, HTTPException, Form, Depends, Query, File, UploadFile, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
-import google.oauth2.id_token;
+import google.auth.jwt
 from google.auth.transport import requests
-from google.cloud import firestore
 import starlette.status as status
-from google.cloud.firestore_v1.base_query import FieldFilter
 from typing import List
 import uuid
 import secrets
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List, Dict, Any
+import base64
+import csv
+import io
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+import anyio
+import asyncio
+from local_constants import (BOOKINGS_PAGE_SIZE, API_MAX_PAGE_SIZE, LISTING_BATCH_SIZE, BULK_MAX_BOOKINGS, READ_CACHE_TTL_SECONDS, READ_CACHE_MAX_ENTRIES,
+                             FIRESTORE_MAX_CONCURRENCY,
+                             FIREBASE_PROJECT_ID, VERIFIED_TOKEN_CACHE_SIZE, CERTS_REFRESH_INTERVAL_SECONDS, SLOW_REQUEST_SECONDS,
+                             KNOWN_USER_CACHE_SIZE, KNOWN_USER_TTL_SECONDS, LIVE_QUEUE_SIZE, LIVE_KEEPALIVE_SECONDS,
+                             JOB_HISTORY_SIZE, JOB_TTL_SECONDS, COMPRESS_MINIMUM_SIZE, STATIC_MAX_AGE_SECONDS,
+                             FRAGMENT_CACHE_MAX_ENTRIES)
+from live import LiveHub, sse_message
+from responses import (CompressResponses, DataVersions, FingerprintedStaticFiles, StaticAssets, build_version,
+                       content_version, is_not_modified, not_modified, validator_headers)
+from instrumentation import InstrumentedRepository, RequestStats, current_stats, log_event, registry
+from storage import (BOOKING_ORDER, DATE_BOOKING_ORDER, RANGE_BOOKING_ORDER, RoomBeingRemoved, create_repository, date_range,
+                     normalize_booking_times)
 
 app = FastAPI()
 
-firestore_db = firestore.Client()
+# Rooms, bookings and users live behind a repository; see storage.py for the backends.
+# Every call through it is timed and counted per request.
+repository = InstrumentedRepository(create_repository())
 
 firebase_request_adapter = requests.Request()
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+class TTLCache:
+    """
+    A small thread-safe LRU cache whose entries expire after `ttl` seconds.
+    Writers invalidate entries explicitly; the TTL bounds staleness across workers.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # Returns (True, value) on a fresh hit and (False, None) otherwise
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        # Drop the given keys, or everything when called without arguments
+        with self._lock:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl
+            }
+
+class FirebaseTokenVerifier:
+    """
+    Verifies Firebase ID tokens offline against Google's public keys.
+    The keys are cached for as long as their Cache-Control max-age allows, and
+    verified claims are memoized until the token's `exp` in a bounded LRU keyed
+    by a hash of the token. A token with an unknown key id refetches the keys at
+    most once per `refresh_interval` seconds; other such tokens are rejected.
+    """
+
+    certs_url = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+
+    def __init__(self, request_adapter, audience=None, max_tokens=1024, refresh_interval=60):
+        self.request_adapter = request_adapter
+        self.audience = audience
+        self.max_tokens = max_tokens
+        self.refresh_interval = refresh_interval
+        self._certs = None
+        self._certs_expiry = 0
+        self._certs_fetched = None
+        self._claims = OrderedDict()
+        self._lock = threading.Lock()
+        # Held while fetching keys, so concurrent requests share one fetch
+        self._fetch_lock = threading.RLock()
+
+    def cached_claims(self, id_token):
+        # Claims of an already verified, unexpired token, or None
+        key = hashlib.sha256(id_token.encode()).hexdigest()
+        with self._lock:
+            entry = self._claims.get(key)
+            if entry is None:
+                return None
+            if entry['exp'] <= time.time():
+                del self._claims[key]
+                return None
+            self._claims.move_to_end(key)
+            return entry
+
+    def verify(self, id_token):
+        # Raises ValueError if the token is invalid or expired
+        claims = self.cached_claims(id_token)
+        if claims is not None:
+            return claims
+
+        certs = self._get_certs()
+        kid = google.auth.jwt.decode_header(id_token).get('kid')
+        if kid not in certs:
+            certs = self._refresh_certs(kid)
+
+        claims = google.auth.jwt.decode(id_token, certs=certs, audience=self.audience)
+
+        key = hashlib.sha256(id_token.encode()).hexdigest()
+        with self._lock:
+            self._claims[key] = claims
+            while len(self._claims) > self.max_tokens:
+                self._claims.popitem(last=False)
+        return claims
+
+    def _refresh_certs(self, kid):
+        # The token may be signed with a key published since we fetched ours
+        with self._fetch_lock:
+            with self._lock:
+                certs = self._certs
+                fetched = self._certs_fetched
+            # Another thread may have fetched the key while this one waited
+            if certs is not None and kid in certs:
+                return certs
+            if fetched is not None and time.monotonic() - fetched < self.refresh_interval:
+                raise ValueError(f"Token signed with unknown key id {kid!r}")
+            return self._get_certs(refresh=True)
+
+    def _get_certs(self, refresh=False):
+        with self._lock:
+            if not refresh and self._certs is not None and self._certs_expiry > time.monotonic():
+                return self._certs
+
+        with self._fetch_lock:
+            with self._lock:
+                # Another thread may have fetched the keys while this one waited
+                if not refresh and self._certs is not None and self._certs_expiry > time.monotonic():
+                    return self._certs
+                # Failed fetches count too, so a key server outage is not hammered either
+                self._certs_fetched = time.monotonic()
+
+            response = self.request_adapter(self.certs_url, method="GET")
+            if response.status != 200:
+                raise ValueError(f"Could not fetch certificates at {self.certs_url}")
+            certs = json.loads(response.data.decode("utf-8"))
+
+            # Honour the max-age Google publishes with the keys
+            cache_control = response.headers.get("cache-control", "")
+            max_age = re.search(r"max-age=(\d+)", cache_control)
+
+            with self._lock:
+                self._certs = certs
+                self._certs_expiry = time.monotonic() + (int(max_age.group(1)) if max_age else 0)
+            return certs
+
+token_verifier = FirebaseTokenVerifier(firebase_request_adapter, audience=FIREBASE_PROJECT_ID, max_tokens=VERIFIED_TOKEN_CACHE_SIZE,
+                                       refresh_interval=CERTS_REFRESH_INTERVAL_SECONDS)
+
+# Read models for the room list and the dashboard, shared by every request in this process
+read_cache = TTLCache(READ_CACHE_MAX_ENTRIES, READ_CACHE_TTL_SECONDS)
+
+# One storage listener feeding every browser on /live/bookings
+live_hub = LiveHub(LIVE_QUEUE_SIZE)
+
+# Profiles of users already seen, so signed-in page loads skip the users/{uid} read
+known_users = TTLCache(KNOWN_USER_CACHE_SIZE, KNOWN_USER_TTL_SECONDS)
+
+# Rendered page fragments, keyed by the version of the data they show, so they never need invalidating
+fragment_cache = TTLCache(FRAGMENT_CACHE_MAX_ENTRIES, READ_CACHE_TTL_SECONDS)
+
+# Versions of the read models, the ETags and Last-Modified dates of the pages built from them
+data_versions = DataVersions()
+
+# Background jobs of this worker (room removals), kept for a while so their progress can be polled
+jobs = TTLCache(JOB_HISTORY_SIZE, JOB_TTL_SECONDS)
+
+# The Firestore client and token verification are blocking, so handlers run them on
+# worker threads. The limiter bounds how many run at once across the whole worker.
+blocking_limiter = None
+
+async def run_blocking(func, *args, **kwargs):
+    global blocking_limiter
+    if blocking_limiter is None:
+        blocking_limiter = anyio.CapacityLimiter(FIRESTORE_MAX_CONCURRENCY)
+    return await anyio.to_thread.run_sync(partial(func, *args, **kwargs), limiter=blocking_limiter)
+
+async def get_user_token(request: Request):
+    """
+    FastAPI dependency returning the verified claims of the request's token cookie, or None.
+    The result is kept on request.state so a request verifies its token at most once.
+    """
+    if not hasattr(request.state, 'user_token'):
+        id_token = request.cookies.get("token")
+
+        # Memoized tokens are answered without leaving the event loop
+        user_token = token_verifier.cached_claims(id_token) if id_token else None
+        if user_token is None:
+            user_token = await run_blocking(validate_firebase_token, id_token)
+        request.state.user_token = user_token
+
+    return request.state.user_token
+
+async def require_user_token(user_token: dict = Depends(get_user_token)):
+    # JSON endpoints answer 401 instead of redirecting to the login page
+    if not user_token:
+        raise HTTPException(status_code=401, detail="Missing or invalid ID token")
+    return user_token
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    # Collects the request's storage operations, then reports them in Server-Timing, /metrics and the log
+    stats = RequestStats()
+    context_token = current_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_stats.reset(context_token)
+    elapsed = time.perf_counter() - started
+
+    # Label by route template so /edit/booking/{booking_id} is one series, not one per booking
+    route = request.scope.get('route')
+    route_path = route.path if route is not None else "unmatched"
+    registry.observe_request(request.method, route_path, response.status_code, elapsed)
+    response.headers['Server-Timing'] = stats.server_timing(elapsed)
+
+    log_event(logging.WARNING if elapsed >= SLOW_REQUEST_SECONDS else logging.INFO, "request",
+              method=request.method, route=route_path, status=response.status_code,
+              duration_ms=round(elapsed * 1000, 1), storage_ms=round(stats.storage_seconds() * 1000, 1),
+              **stats.counts, documents=stats.documents)
+    return response
+
+# Compress everything but the live-update streams, which must reach the browser event by event
+app.add_middleware(CompressResponses, minimum_size=COMPRESS_MINIMUM_SIZE, skip_prefixes=("/live/",))
+
+# Templates link static files by content hash, so browsers can keep them until they change
+static_assets = StaticAssets("static", "/static")
+app.mount("/static", FingerprintedStaticFiles(directory="static", assets=static_assets, max_age=STATIC_MAX_AGE_SECONDS), name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.globals['static_url'] = static_assets.url
+# Part of every page's ETag, so pages cached before a deploy are not revalidated as current
+page_build = build_version("templates", static_assets)
 
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
-    id_token = request.cookies.get("token")
+async def root(request: Request, user_token: dict = Depends(get_user_token)):
     error_message = "No error here"
-    user_token = None
     user = None
 
-    user_token = validate_firebase_token(id_token)
     if not user_token:
         return templates.TemplateResponse("main.html", {"request": request, 'user_token': None, 'error_message': None, 'user_info': None})
 
-    user = get_user(user_token).get()
+    user = await run_blocking(get_user, user_token)
 
-    rooms = fetch_all_rooms()
+    # The room list, booking counts and active dates all come from the dashboard read model
+    dashboard, (version, modified_at) = await run_blocking(fetch_dashboard)
 
-    dates = fetch_dates_for_room()
+    # The page depends on the dashboard and on who is signed in; repeat views are answered with a 304
+    etag = f'W/"{page_build}-{version}-{content_version([user_token["user_id"], user_token.get("email"), user])}"'
+    if is_not_modified(request, etag, modified_at):
+        return not_modified(etag, modified_at)
 
-    return templates.TemplateResponse("main.html", 
+    response = templates.TemplateResponse("main.html", 
                                       {"request": request, 
                                        'user_token': user_token, 
                                        'error_message': error_message, 
                                        'user_info': user, 
-                                       "rooms": rooms,
-                                       "dates": dates})
+                                       "rooms": dashboard['rooms'],
+                                       "room_list": render_room_list(dashboard['rooms'], version, user_token),
+                                       "dates": dashboard['dates']})
+    response.headers.update(validator_headers(etag, modified_at))
+    return response
 
 @app.post("/create-room")
-async def create_room(request: Request, name: str = Form(...)):
+async def create_room(request: Request, name: str = Form(...), validated_user_token: dict = Depends(get_user_token)):
     confirmation_message = None
 
     # Retrieve the ID token from cookies
-    id_token = request.cookies.get("token")
-    if not id_token:
+    if not request.cookies.get("token"):
         raise HTTPException(status_code=400, detail="Missing ID token")
 
-    # Retrieve available rooms for booking
-    rooms = fetch_all_rooms()
-
-    # Validate the user token; redirect if invalid
-    validated_user_token = validate_firebase_token(id_token)
+    # Redirect if the user token is invalid
     if not validated_user_token:
         return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
 
     # Attempt to create a new room with the provided name
     try:
-        create_room_document(validated_user_token['user_id'] ,name)
+        await run_blocking(create_room_document, validated_user_token['user_id'], name)
         confirmation_message = f"Successfully created room: '{name}'."
     except Exception as e:
         # Handle exceptions or failures during room creation
         confirmation_message = f"Failed to create room: '{name}'. Error: {str(e)}"
 
     # Gather additional necessary data for the response, if any
-    user = get_user(validated_user_token)
+    user = await run_blocking(get_user, validated_user_token)
 
-    print(confirmation_message)
+    # Like the landing page, the room list and its booking counts come from the dashboard, read after the write
+    dashboard, (version, modified_at) = await run_blocking(fetch_dashboard)
+
+    log_event(logging.INFO, "create_room", name=name, user_id=validated_user_token['user_id'], message=confirmation_message)
 
     # Return to the main page with a message regarding the room creation attempt
     return templates.TemplateResponse("main.html", {
@@ -83,37 +347,38 @@ async def create_room(request: Request, name: str = Form(...)):
         "user_details": user,
         'user_token': validated_user_token,
         'operation_message': confirmation_message,
-        'rooms': rooms
+        'rooms': dashboard['rooms'],
+        'room_list': render_room_list(dashboard['rooms'], version, validated_user_token),
+        'dates': dashboard['dates']
     })
 
 @app.get("/reserve", response_class=HTMLResponse)
-async def reserve(request: Request):
-    # Attempt to validate the user session
-    id_token = request.cookies.get("token")
-    user_token = validate_firebase_token(id_token)
-
+async def reserve(request: Request, user_token: dict = Depends(get_user_token)):
     # Redirect if user token is not found or invalid
     if not user_token:
         return RedirectResponse("/")
 
     # Retrieve available rooms for booking
-    rooms = fetch_all_rooms()
+    rooms = await run_blocking(fetch_all_rooms)
 
-    # Render the booking page with room details
-    return templates.TemplateResponse("book.html", {"request": request, "rooms": rooms})
+    # Render the booking page with room details; it is never reused, since its idempotency key must be fresh
+    return templates.TemplateResponse("book.html", {"request": request, "rooms": rooms, "idempotency_key": secrets.token_urlsafe(16)},
+                                      headers={'Cache-Control': "no-store"})
 
 @app.post("/reserve-room")
-async def reserve_space(request: Request, room_name: str = Form(...), date: str = Form(...), start_time: str = Form(...), end_time: str = Form(...)):
-    # Validate user session again for the form submission
-    id_token = request.cookies.get("token")
-    user_token = validate_firebase_token(id_token)
-
+async def reserve_space(request: Request, room_name: str = Form(...), date: str = Form(...), start_time: str = Form(...), end_time: str = Form(...),
+                        idempotency_key: str = Form(None), user_token: dict = Depends(get_user_token)):
     # Ensure user is authenticated before proceeding
     if not user_token:
         return RedirectResponse("/")
 
+    # A double-submitted form or a retried request carries the same key (form field or
+    # Idempotency-Key header), so it maps to the same booking id and is stored only once
+    idempotency_key = idempotency_key or request.headers.get("Idempotency-Key")
+    booking_id = idempotent_booking_id(user_token['user_id'], idempotency_key) if idempotency_key else generate_random_id()
+
     booking_data = {
-        "id": generate_random_id(), 
+        "id": booking_id, 
        "room_name": room_name, 
        "date": date, 
        "start_time": start_time, 
@@ -121,187 +386,249 @@ async def reserve_space(request: Request, room_name: str = Form(...), date: str
        "booked_by": user_token['user_id']
     }
 
-    rooms = fetch_all_rooms()
-
-    dates = fetch_dates_for_room()
+    rooms = await run_blocking(fetch_all_rooms)
 
     # Attempt to create a booking
     try:
-        success, message = create_booking_document(room_name, date, booking_data)
+        success, message = await run_blocking(create_booking_document, room_name, date, booking_data)
         if success:
             # Successful booking, redirect to the booking page with a success message
-            return templates.TemplateResponse("book.html", {"request": request, "message": message, "rooms": rooms, "dates": dates})
+            return templates.TemplateResponse("book.html", {"request": request, "message": message, "rooms": rooms, "idempotency_key": secrets.token_urlsafe(16)})
         else:
             # Failed to create booking, stay on the booking page with an error message
-            return templates.TemplateResponse("book.html", {"request": request, "message": message, "rooms": rooms, "dates": dates})
+            return templates.TemplateResponse("book.html", {"request": request, "message": message, "rooms": rooms, "idempotency_key": secrets.token_urlsafe(16)})
     except Exception as e:
         # Return to booking page with an error message if exception occurs
-        return templates.TemplateResponse("book.html", {"request": request, "message": str(e), "rooms": rooms, "dates": dates})
+        return templates.TemplateResponse("book.html", {"request": request, "message": str(e), "rooms": rooms, "idempotency_key": secrets.token_urlsafe(16)})
+
+@app.post("/bookings/bulk")
+async def bulk_create_bookings(file: UploadFile = File(None), room_name: str = Form(None), date: str = Form(None),
+                               start_time: str = Form(None), end_time: str = Form(None),
+                               frequency: str = Form("weekly"), count: int = Form(1),
+                               user_token: dict = Depends(require_user_token)):
+    """
+    Creates many bookings at once, either from an uploaded CSV or JSON file with
+    room_name, date, start_time and end_time per booking, or from a recurrence
+    rule (the first date, 'daily' or 'weekly', and a number of occurrences).
+    Nothing is written if any booking is invalid or overlaps another.
+    """
+    if file is not None:
+        bookings = parse_bulk_upload(file.filename or "", await file.read())
+    elif room_name and date and start_time and end_time:
+        bookings = expand_recurrence(room_name, date, start_time, end_time, frequency, count)
+    else:
+        raise HTTPException(status_code=400, detail="Upload a file or give room_name, date, start_time and end_time")
+
+    if not bookings:
+        raise HTTPException(status_code=400, detail="No bookings to create")
+
+    if len(bookings) > BULK_MAX_BOOKINGS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_BOOKINGS} bookings can be created at once")
+
+    for booking in bookings:
+        booking['id'] = generate_random_id()
+        booking['booked_by'] = user_token['user_id']
+
+    errors = await run_blocking(create_booking_documents, bookings)
+    if errors and all(error.get('retry') for error in errors):
+        # Only days booked concurrently were skipped; every other booking was stored
+        skipped = {error['row'] for error in errors}
+        ids = [booking['id'] for position, booking in enumerate(bookings) if position not in skipped]
+        return JSONResponse({"created": len(ids), "ids": ids, "errors": errors}, status_code=409)
+    if errors:
+        return JSONResponse({"created": 0, "errors": errors}, status_code=409)
+
+    return JSONResponse({"created": len(bookings), "ids": [booking['id'] for booking in bookings]}, status_code=201)
 
 @app.post("/show_bookings", response_class=HTMLResponse)
-async def show_bookings(request: Request, user_id: str = Form(...)):
-    try:
-        # Retrieve bookings for the current user
-        user_bookings = get_all_user_bookings(user_id)
+async def show_bookings(request: Request, cursor: str = Form(None), user_token: dict = Depends(get_user_token)):
+    # The bookings shown are always the signed-in user's own, whatever the form posts
+    if not user_token:
+        return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
 
-        print("Booked for User:", user_bookings)
+    try:
+        # Retrieve one page of bookings for the current user
+        user_bookings, next_cursor = await run_blocking(get_user_bookings_page, user_token['user_id'], cursor)
 
         # Render template with user's bookings
-        return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": user_bookings})
+        return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": user_bookings, "next_cursor": next_cursor})
     except Exception as e:
         # Handle errors or exceptions
         return templates.TemplateResponse("bookings.html", {"request": request, "error_message": str(e)})
 
 @app.post("/room-bookings")
-async def room_bookings(request: Request, name: str = Form(...)):
-    id_token = request.cookies.get("token")
-    user_token = validate_firebase_token(id_token)
-
-    bookings = get_bookings_for_room(name, user_token['user_id'])
-
-    print("Bookings:", bookings)
+async def room_bookings(request: Request, name: str = Form(...), user_token: dict = Depends(get_user_token)):
+    bookings = await run_blocking(get_bookings_for_room, name, user_token['user_id'])
 
     # Instead of returning the bookings directly, render them in a template
     return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": bookings, "room": name})
 
 @app.get("/room-bookings/{room_name}")
-async def get_room_bookings(request: Request, room_name: str):
-    id_token = request.cookies.get("token")
-    user_token = validate_firebase_token(id_token)
+async def get_room_bookings(request: Request, room_name: str, user_token: dict = Depends(get_user_token)):
+    bookings = await run_blocking(get_bookings_for_room, room_name, user_token['user_id'])
 
-    bookings = get_bookings_for_room(room_name, user_token['user_id'])
+    etag = f'W/"{page_build}-{content_version([room_name, bookings])}"'
+    if is_not_modified(request, etag):
+        return not_modified(etag)
 
     # Instead of returning the bookings directly, render them in a template
-    return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": bookings, "room": room_name})
-
-def get_bookings_for_room(room_name, user_id):
-    room_bookings = []
-
-    # Query Firestore to get the room document by its name
-    room_ref = firestore_db.collection('rooms').where(filter=FieldFilter('name', '==', room_name)).limit(1).get()
-
-    # Iterate over the room documents (should be just one)
-    for room_doc in room_ref:
-        # Get the room ID
-        room_id = room_doc.id
-        
-        # Query Firestore to get the bookings for the specified room
-        days_ref = firestore_db.collection('rooms').document(room_id).collection('days').get()
-        
-        # Iterate over the days
-        for day_doc in days_ref:
-            day_id = day_doc.id
-            # bookings_ref = firestore_db.collection('rooms').document(room_id).collection('days').document(day_id).collection('bookings').where(filter=FieldFilter('user_id', '==', user_id)).get()
-            bookings_ref = firestore_db.collection('rooms').document(room_id).collection('days').document(day_id).collection('bookings').where(filter=FieldFilter('booked_by', '==', user_id)).get()
-
-            # Iterate over the bookings and append them to the list
-            for booking_doc in bookings_ref:
-                booking_data = booking_doc.to_dict()
-                print("booking Data: ", booking_data)
-                room_bookings.append(booking_data)
-
-    return room_bookings
+    return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": bookings, "room": room_name},
+                                      headers=validator_headers(etag))
 
 @app.get("/delete/booking/{booking_id}")
 async def delete_booking_simple(request: Request ,booking_id: str):
-    rooms_ref = firestore_db.collection('rooms')
-    
-    # Attempt to find and delete the booking in each room and day
-    for room_doc in rooms_ref.stream():
-        days_ref = rooms_ref.document(room_doc.id).collection('days')
-        for day_doc in days_ref.stream():
-            bookings_ref = days_ref.document(day_doc.id).collection('bookings')
-            bookings = bookings_ref.where(filter=FieldFilter('id', '==', booking_id)).stream()
-
-            for booking in bookings:
-                # Delete the found booking
-                booking.reference.delete()
-                return {"message": "Booking deleted successfully"}
+    # Resolve the booking through the booking index instead of scanning every room and day
+    try:
+        deleted = await run_blocking(delete_booking_document, booking_id)
+    except RoomBeingRemoved as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Booking not found")
 
-    # If the loop completes without returning, no booking was found
-    raise HTTPException(status_code=404, detail="Booking not found")
+    return {"message": "Booking deleted successfully"}
 
 @app.get("/edit/booking/{booking_id}", response_class=HTMLResponse)
 async def edit_booking(request: Request, booking_id: str):
-    # Reference to the 'rooms' collection in Firestore
-    rooms_reference = firestore_db.collection('rooms')
-
-    # Iterate through each room
-    for room_document in rooms_reference.stream():
-        # Reference to the 'days' collection for the current room
-        days_collection = rooms_reference.document(room_document.id).collection('days')
-        
-        # Iterate through each day
-        for day_document in days_collection.stream():
-            # Reference to the 'bookings' collection for the current day
-            bookings_collection = days_collection.document(day_document.id).collection('bookings')
-            
-            # Query for the specific booking by ID
-            targeted_booking = bookings_collection.where(filter=FieldFilter('id', '==', booking_id)).stream()
-            
-            # If a booking is found, send its data to the template
-            for booking_document in targeted_booking:
-                booking_details = booking_document.to_dict()
-                return templates.TemplateResponse("edit_booking.html", {"request": request, "booking": booking_details})
-
-    # If the function reaches this point, no booking was found
-    raise HTTPException(status_code=404, detail="Booking not found")
+    booking_details = await run_blocking(get_booking_document, booking_id)
+    if booking_details is None:
+        raise HTTPException(status_code=404, detail="Booking not found")
+
+    # Send the booking data to the template
+    return templates.TemplateResponse("edit_booking.html", {"request": request, "booking": booking_details})
 
 @app.post("/save-update/{booking_id}")
 async def update_booking(request: Request, booking_id: str, start_time: str = Form(...), end_time: str = Form(...), date: str = Form(...)):
-    # Reference to the 'rooms' collection in Firestore
-    rooms_reference = firestore_db.collection('rooms')
-
-    # Iterate through each room
-    for room_document in rooms_reference.stream():
-        # Reference to the 'days' collection for the current room
-        days_collection = rooms_reference.document(room_document.id).collection('days')
-        
-        # Iterate through each day
-        for day_document in days_collection.stream():
-            # Reference to the 'bookings' collection for the current day
-            bookings_collection = days_collection.document(day_document.id).collection('bookings')
-            
-            # Query for the specific booking by ID
-            targeted_booking = bookings_collection.where(filter=FieldFilter('id', '==', booking_id)).stream()
-            
-            # If a booking is found, update its data and return success message
-            for booking_document in targeted_booking:
-                booking_data = booking_document.to_dict()
-                booking_data['start_time'] = start_time
-                booking_data['end_time'] = end_time
-                booking_data['date'] = date
-
-                # Save the updated booking data back to Firestore
-                booking_document.reference.update(booking_data)
-
-                # Return success message along with the updated booking details
-                return templates.TemplateResponse("edit_booking.html", {"request": request, "booking": booking_data, 'message': "Booking updated successfully"})
-    
-    # If no booking was found, raise HTTPException
-    raise HTTPException(status_code=404, detail="Booking not found")
+    try:
+        booking_data, conflict = await run_blocking(update_booking_document, booking_id, date, start_time, end_time)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RoomBeingRemoved as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if booking_data is None:
+        raise HTTPException(status_code=404, detail="Booking not found")
+
+    if conflict:
+        # Keep the booking unchanged and tell the user which slot is taken
+        message = f"The room is already booked from {conflict['start']} to {conflict['end']} on {date}."
+        return templates.TemplateResponse("edit_booking.html", {"request": request, "booking": booking_data, 'message': message})
+
+    # Return success message along with the updated booking details
+    return templates.TemplateResponse("edit_booking.html", {"request": request, "booking": booking_data, 'message': "Booking updated successfully"})
 
 @app.get('/room/delete/{name}')
-async def delete_room(request: Request, name: str):
-    # Get the user's ID from the request
-    user_id = get_user_id_from_request(request)
+async def delete_room(request: Request, name: str, user_token: dict = Depends(get_user_token)):
+    # Get the user's ID from the request's token
+    user_id = user_token['user_id']
 
-    # Retrieve the room document from Firestore
-    room_doc = get_room_document(name)
+    # Retrieve the room
+    room = await run_blocking(get_room_document, name)
 
     # Check if the room exists and if the user is the creator
-    check_room_existence_and_authorization(room_doc, user_id)
-
-    # Check if there are any bookings associated with any day in the room
-    if room_has_bookings(room_doc):
-        raise HTTPException(status_code=400, detail="Cannot delete room with existing bookings")
+    check_room_existence_and_authorization(room, user_id)
 
-    # Delete the room
-    delete_room_document(room_doc)
+    # Delete the room unless it has bookings; the repository checks its count in the same transaction as the delete
+    try:
+        await run_blocking(delete_room_document, room)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Cannot delete room with existing bookings; remove it with its bookings at /room/remove/{name}")
 
     # Redirect to the main page
     return RedirectResponse(url="/", status_code=303)
 
+@app.get('/room/remove/{name}', response_class=HTMLResponse)
+async def confirm_remove_room(request: Request, name: str, user_token: dict = Depends(get_user_token)):
+    # Confirmation page for deleting or archiving a room together with its bookings
+    if not user_token:
+        return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+    room, removal = await run_blocking(get_removable_room, name)
+    check_room_existence_and_authorization(room, user_token['user_id'])
+    return templates.TemplateResponse("remove_room.html", {"request": request, "room": room, "removal": removal})
+
+@app.post('/room/remove/{name}', response_class=HTMLResponse)
+async def remove_room(request: Request, name: str, background_tasks: BackgroundTasks,
+                      mode: str = Form(..., pattern="^(force|archive)$"), confirm_name: str = Form(...),
+                      user_token: dict = Depends(get_user_token)):
+    """
+    Deletes a room with all its bookings (mode=force), or archives them to
+    archived_rooms first (mode=archive). The room's name must be typed again to
+    confirm. Both run as a background job whose progress is polled on /jobs/{job_id}.
+    A removal that failed part way is resumed in the mode it was started with.
+    Only one run of a room's removal goes at a time; a repeated submit is refused.
+    """
+    if not user_token:
+        return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
+    user_id = user_token['user_id']
+    room, removal = await run_blocking(get_removable_room, name)
+    check_room_existence_and_authorization(room, user_id)
+
+    if confirm_name != name:
+        return templates.TemplateResponse("remove_room.html", {"request": request, "room": room, "removal": removal,
+                                                               "message": "The name typed does not match the room's name."}, status_code=400)
+
+    if removal:
+        mode = 'archive' if removal['archive'] else 'force'
+    try:
+        # Claimed before the response is sent, so a double-clicked submit finds the removal running
+        lease = await run_blocking(repository.start_room_removal, name, mode == 'archive')
+    except ValueError as e:
+        removal = dict(removal or {'room': room, 'archive': mode == 'archive'}, in_progress=True)
+        return templates.TemplateResponse("remove_room.html", {"request": request, "room": room, "removal": removal,
+                                                               "message": str(e)}, status_code=409)
+    job = start_job('remove_room', user_id, room=name, mode=mode, total=room.get('booking_count') or 0)
+    background_tasks.add_task(remove_room_in_background, job, name, lease, mode == 'archive')
+    return templates.TemplateResponse("remove_room.html", {"request": request, "room": room, "job": job}, status_code=202)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, user_token: dict = Depends(require_user_token)):
+    # Progress of a background job started by the signed-in user
+    found, job = jobs.get(job_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job['user_id'] != user_token['user_id']:
+        raise HTTPException(status_code=403, detail="Unauthorized: Only the job's creator can see it")
+    return dict(job)
+
+@app.get("/cache-stats")
+async def cache_stats():
+    # Hit/miss counters of the in-process read cache
+    return read_cache.stats()
+
+@app.get("/live/bookings")
+async def live_bookings(request: Request, room: str = None, date: str = None, user_token: dict = Depends(require_user_token)):
+    """
+    Server-sent events for the pages of /room-bookings (with `room`) or /filter-date
+    (with `date`): a 'snapshot' of the matching bookings, then a booking_added,
+    booking_modified or booking_removed event for every change, from one shared listener.
+    """
+    if (room is None) == (date is None):
+        raise HTTPException(status_code=400, detail="Give either room or date")
+
+    await run_blocking(live_hub.start, repository)
+    subscriber, snapshot = live_hub.subscribe(live_filter(user_token['user_id'], room, date))
+    return StreamingResponse(stream_live_events(request, subscriber, snapshot), media_type="text/event-stream",
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.get("/metrics")
+async def metrics():
+    # Request and storage counters in the Prometheus text format
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/availability")
+async def availability(date: str, duration: int = 30, from_time: str = Query("00:00", alias="from"), to_time: str = Query("23:59", alias="to")):
+    # Free windows of at least `duration` minutes between `from` and `to`, for every room
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+        window_start, window_end = normalize_booking_times(from_time, to_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date must be YYYY-MM-DD and from/to HH:MM with from before to")
+
+    if duration <= 0:
+        raise HTTPException(status_code=400, detail="Duration must be a positive number of minutes")
+
+    rooms = await run_blocking(fetch_room_availability, date, window_start, window_end, duration)
+    return {"date": date, "duration": duration, "from": window_start, "to": window_end, "rooms": rooms}
+
 @app.get("/filter-date")
 async def filter_bookings_by_day(request: Request, date: str):
     try:
@@ -309,19 +636,17 @@ async def filter_bookings_by_day(request: Request, date: str):
         target_date = datetime.strptime(date, "%Y-%m-%d").date()
 
         # Retrieve rooms from Firestore
-        rooms = fetch_all_rooms()
+        rooms = await run_blocking(fetch_all_rooms)
 
         # List to store room bookings
-        room_bookings = []
+        room_bookings = await run_blocking(fetch_bookings_for_rooms_on_date, [room.get("name") for room in rooms], target_date)
 
-        # Iterate over rooms
-        for room in rooms:
-            room_name = room.get("name")
-            bookings = fetch_bookings_for_room_on_date(room_name, target_date)
-            print("booking: ", bookings)
-            room_bookings.extend(bookings)
+        etag = f'W/"{page_build}-{content_version([date, room_bookings])}"'
+        if is_not_modified(request, etag):
+            return not_modified(etag)
 
-        return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": room_bookings, "date": date})
+        return templates.TemplateResponse("bookings.html", {"request": request, "user_bookings": room_bookings, "date": date},
+                                          headers=validator_headers(etag))
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Date must be in the format YYYY-MM-DD")
     except Exception as e:
@@ -329,180 +654,413 @@ async def filter_bookings_by_day(request: Request, date: str):
         error_message = "Failed to filter bookings by day: " + str(e)
         raise HTTPException(status_code=500, detail=error_message)
 
-def fetch_bookings_for_room_on_date(room_name: str, date: datetime.date) -> List[Dict[str, Any]]:
-    room_bookings = []
+@app.get("/api/rooms")
+async def api_rooms(limit: int = Query(BOOKINGS_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE), cursor: str = None,
+                    format: str = Query("json", pattern="^(json|ndjson)$"), user_token: dict = Depends(require_user_token)):
+    return await api_listing(repository.iter_rooms, ['name'], limit, cursor, format)
+
+@app.get("/api/bookings")
+async def api_user_bookings(limit: int = Query(BOOKINGS_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE), cursor: str = None,
+                            format: str = Query("json", pattern="^(json|ndjson)$"), user_token: dict = Depends(require_user_token)):
+    # The signed-in user's bookings, read from their projection
+    return await api_listing(partial(repository.iter_user_bookings, user_token['user_id']), BOOKING_ORDER, limit, cursor, format)
+
+@app.get("/api/rooms/{room_name}/bookings")
+async def api_room_bookings(room_name: str, limit: int = Query(BOOKINGS_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE), cursor: str = None,
+                            format: str = Query("json", pattern="^(json|ndjson)$"), user_token: dict = Depends(require_user_token)):
+    # The signed-in user's bookings of one room, like /room-bookings
+    return await api_listing(partial(repository.iter_user_bookings, user_token['user_id'], room_name=room_name), BOOKING_ORDER, limit, cursor, format)
+
+@app.get("/api/bookings/by-date")
+async def api_bookings_by_date(date: str, limit: int = Query(BOOKINGS_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE), cursor: str = None,
+                               format: str = Query("json", pattern="^(json|ndjson)$"), user_token: dict = Depends(require_user_token)):
+    # Every room's bookings for one day, like /filter-date
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Date must be in the format YYYY-MM-DD")
+
+    return await api_listing(partial(repository.iter_bookings_on_date, date), DATE_BOOKING_ORDER, limit, cursor, format)
 
-    # Query Firestore to get the room document by its name
-    room_ref = firestore_db.collection('rooms').where(filter=FieldFilter('name', '==', room_name)).limit(1).get()
+@app.get("/api/bookings/range")
+async def api_bookings_in_range(from_date: str = Query(..., alias="from"), to_date: str = Query(..., alias="to"), room: str = None,
+                                limit: int = Query(BOOKINGS_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE), cursor: str = None,
+                                format: str = Query("json", pattern="^(json|ndjson)$"), user_token: dict = Depends(require_user_token)):
+    # Every booking starting between two dates (both included), optionally of one room, in start order
+    try:
+        start, end = date_range(from_date, to_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Dates must be in the format YYYY-MM-DD")
 
-    # Iterate over the room documents (should be just one)
-    for room_doc in room_ref:
-        # Get the room ID
-        room_id = room_doc.id
-        
-        # Query Firestore to get the bookings for the specified room on the given date
-        bookings_ref = firestore_db.collection('rooms').document(room_id).collection('days').document(date.isoformat()).collection('bookings').get()
+    if end <= start:
+        raise HTTPException(status_code=400, detail="The 'to' date must not be before the 'from' date")
 
-        # Iterate over the bookings and append them to the list
-        for booking_doc in bookings_ref:
-            booking_data = booking_doc.to_dict()
-            room_bookings.append(booking_data)
+    return await api_listing(partial(repository.iter_bookings_in_range, start, end, room), RANGE_BOOKING_ORDER, limit, cursor, format)
 
-    return room_bookings
+def get_bookings_for_room(room_name, user_id):
+    return repository.get_bookings_for_room(room_name, user_id)
 
-def get_user_id_from_request(request: Request) -> str:
-    # Extract user ID from the request's token
-    id_token = request.cookies.get("token")
-    user_token = validate_firebase_token(id_token)
-    return user_token['user_id']
+def fetch_bookings_for_rooms_on_date(room_names: List[str], date: datetime.date) -> List[Dict[str, Any]]:
+    return repository.get_bookings_on_date(room_names, date.isoformat())
 
 def get_room_document(name: str):
-    # Retrieve the room document from Firestore
-    room_ref = firestore_db.collection('rooms').document(name)
-    room_doc = room_ref.get()
-    if not room_doc.exists:
+    room = repository.get_room(name)
+    if room is None:
         raise HTTPException(status_code=404, detail="Room not found")
-    return room_doc
-
+    return room
+
+def get_removable_room(name: str):
+    # A room whose removal failed part way is already gone, but its removal can be run again.
+    # Returns the room and the unfinished removal, if any.
+    room = repository.get_room(name)
+    if room is not None:
+        return room, None
+    removal = repository.get_room_removal(name)
+    if removal is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    return removal['room'], removal
 
-def check_room_existence_and_authorization(room_doc, user_id):
+def check_room_existence_and_authorization(room, user_id):
     # Check if the user is the creator of the room
-    room_data = room_doc.to_dict()
-    if room_data['user_id'] != user_id:
+    if room['user_id'] != user_id:
         raise HTTPException(status_code=403, detail="Unauthorized: Only the creator can delete the room")
 
-def room_has_bookings(room_doc):
-    # Get all days within the room
-    days_ref = room_doc.reference.collection('days').stream()
+def delete_room_document(room):
+    repository.delete_room(room['name'])
+    read_cache.invalidate('rooms', 'dashboard')
 
-    # Check if any day has bookings
-    for day_doc in days_ref:
-        day_bookings_ref = day_doc.reference.collection('bookings')
-        day_bookings = day_bookings_ref.stream()
-        if any(day_bookings):
-            return True  # Room has bookings on at least one day
+def start_job(job_type, user_id, **fields):
+    job = {'id': secrets.token_hex(8), 'type': job_type, 'user_id': user_id, 'status': 'running',
+           'processed': 0, 'total': 0, 'error': None, 'started_at': datetime.utcnow().isoformat(), 'finished_at': None}
+    job.update(fields)
+    jobs.set(job['id'], job)
+    return job
 
-    return False  # Room has no bookings
+def remove_room_in_background(job, name, lease, archive):
+    # Runs on a worker thread after the response has been sent; the job dict is what /jobs reports
+    def report(processed, total):
+        job.update(processed=processed, total=total)
 
-def delete_room_document(room_doc):
-    # Delete the room document
-    room_doc.reference.delete()
+    try:
+        job['processed'] = repository.remove_room(name, lease, progress=report)
+        job['status'] = 'done'
+    except Exception as e:
+        job.update(status='failed', error=str(e))
+        log_event(logging.ERROR, "room_removal_failed", room=name, archive=archive, error=str(e))
+    finally:
+        job['finished_at'] = datetime.utcnow().isoformat()
+        read_cache.invalidate('rooms', 'dashboard')
+
+def live_filter(user_id, room_name, date):
+    # A date page shows every room's bookings; a room page only the user's own, like /room-bookings
+    def matches(kind, data):
+        if kind == 'room':
+            return room_name is not None and data.get('name') == room_name
+        if date is not None:
+            return data.get('date') == date
+        return data.get('room_name') == room_name and data.get('booked_by') == user_id
+    return matches
+
+async def stream_live_events(request, subscriber, snapshot):
+    try:
+        yield sse_message('snapshot', snapshot)
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), LIVE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # Comments keep proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            yield sse_message(event['type'], event['data'])
+    finally:
+        live_hub.unsubscribe(subscriber)
+
+def to_base36(number, length):
+    # Writes `number` as exactly `length` lowercase letters and digits
+    alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
+    digits = []
+    for _ in range(length):
+        number, digit = divmod(number, 36)
+        digits.append(alphabet[digit])
+    return ''.join(reversed(digits))
 
 def generate_random_id(length=12):
-    # Generate a random string of `length` characters (using lowercase letters and digits)
-    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+    # Generate a random string of `length` characters (using lowercase letters and digits) from a single draw
+    return to_base36(secrets.randbelow(36 ** length), length)
 
-def delete_booking_in_day(day_ref, booking_id: str) -> bool:
+def idempotent_booking_id(user_id, idempotency_key, length=12):
+    # The same user and key always give the same id, so a replayed submit finds the booking it already made
+    digest = hashlib.sha256(f"{user_id}:{idempotency_key}".encode()).digest()
+    return to_base36(int.from_bytes(digest, 'big') % 36 ** length, length)
+
+def get_user_bookings_page(user_id, cursor=None, page_size=BOOKINGS_PAGE_SIZE):
     """
-    Searches for and deletes a booking in a specific day.
-    Returns True if the booking was found and deleted, False otherwise.
+    Reads one page of a user's bookings from their booking projection.
+    Returns the bookings and a cursor for the next page (None on the last page).
     """
-    bookings_ref = day_ref.collection('bookings')
-
-    for booking in bookings_ref.where('id', '==', booking_id).stream():
-        booking.reference.delete()
-        return True  # Booking found and deleted
-
-    return False  # Booking not found in this day
-
-def get_all_user_bookings(user_id):
-    bookings_for_user = []
+    return fetch_page(partial(repository.iter_user_bookings, user_id), BOOKING_ORDER, cursor, page_size)
 
-    # Loop through each available room in the collection
-    all_rooms = firestore_db.collection('rooms').get()
+def fetch_page(listing, order_fields, cursor=None, page_size=BOOKINGS_PAGE_SIZE):
+    # Returns one page of rows and the cursor of the next page (None on the last page)
+    # Fetch one extra row to find out whether another page follows
+    rows = list(listing(cursor=decode_cursor(cursor, order_fields) if cursor else None, limit=page_size + 1))
 
-    for room in all_rooms:
-        room_identifier = room.id
-        # Within each room, go through the days it's booked
-        daily_bookings = firestore_db.collection('rooms').document(room_identifier).collection('days').get()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor({field: rows[-1].get(field) for field in order_fields})
 
-        for day in daily_bookings:
-            # Access all bookings for each day and select those made by the specified user
-            all_bookings_today = firestore_db.collection('rooms').document(room_identifier).collection('days').document(day.id).collection('bookings').get()
+    return rows, next_cursor
 
-            for individual_booking in all_bookings_today:
-                detailed_booking_info = individual_booking.to_dict()
-                print("Detailed: ", detailed_booking_info)
-                # user = detailed_booking_info.get('user_id')  # Check if 'user_id' exists
-                user = detailed_booking_info.get('booked_by')  # Check if 'user_id' exists
-                if user and user == user_id:
-                    bookings_for_user.append(detailed_booking_info)
+async def stream_ndjson(listing, cursor):
+    """
+    Yields one JSON document per line straight from the listing, so memory stays flat.
+    The listing is created and its rows pulled LISTING_BATCH_SIZE at a time on worker
+    threads under the blocking limiter, like every other storage call.
+    """
+    rows = await run_blocking(listing, cursor=cursor)
+    while True:
+        batch = await run_blocking(lambda: list(islice(rows, LISTING_BATCH_SIZE)))
+        if not batch:
+            return
+        yield "".join(json.dumps(row, default=json_default) + "\n" for row in batch)
+
+def encode_cursor(values):
+    # Cursors are the ordered field values of the last row, as URL-safe base64 JSON
+    return base64.urlsafe_b64encode(json.dumps(values, default=json_default).encode()).decode()
+
+def json_default(value):
+    # Timestamps are written as ISO 8601, like FastAPI does for JSON responses
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+def decode_cursor(cursor, order_fields):
+    # A cursor must hold exactly the listing's order fields, as encode_cursor wrote them
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if (not isinstance(values, dict) or set(values) != set(order_fields)
+                or not all(isinstance(value, str) for value in values.values())):
+            raise ValueError("Unexpected cursor fields")
+        # Timestamps are compared with the stored ones, which carry a zone
+        if 'starts_at' in values:
+            values['starts_at'] = datetime.fromisoformat(values['starts_at'])
+            if values['starts_at'].tzinfo is None:
+                raise ValueError("Cursor timestamp without a zone")
+        return values
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    return bookings_for_user
+def fetch_dashboard():
+    # Returns the dashboard with its (version, modified_at), cached together so they always match
+    found, versioned_dashboard = read_cache.get('dashboard')
+    if found:
+        return versioned_dashboard
 
-def fetch_dates_for_room():
-    rooms_ref = firestore_db.collection("rooms")
-    available_dates = []
+    dashboard = repository.get_dashboard()
 
-    # Iterate over rooms and their days subcollections
-    for room in rooms_ref.stream():
-        days_ref = rooms_ref.document(room.id).collection("days")
-        for day_doc in days_ref.stream():
-            print(day_doc)
-            # Append each date to the available_dates list
-            available_dates.append(day_doc.id)
+    versioned_dashboard = (dashboard, data_versions.observe('dashboard', dashboard))
+    read_cache.set('dashboard', versioned_dashboard)
+    return versioned_dashboard
 
-    return available_dates
+def render_room_list(rooms, version, user_token):
+    # The room list fragment only changes with the dashboard, and per user only in its delete links
+    key = (version, user_token['user_id'])
+    found, room_list = fragment_cache.get(key)
+    if found:
+        return room_list
 
+    room_list = templates.get_template("room_list.html").render(rooms=rooms, user_token=user_token)
+    fragment_cache.set(key, room_list)
+    return room_list
 
 def fetch_all_rooms():
+    found, room_list = read_cache.get('rooms')
+    if found:
+        return room_list
+
     try:
-        rooms_query_snapshot = firestore_db.collection("rooms").get()
-        room_list = [doc.to_dict() for doc in rooms_query_snapshot]
+        room_list = repository.list_rooms()
+        read_cache.set('rooms', room_list)
         return room_list
     except Exception as e:
-        # Log the error or handle it as needed
-        print(f"Error fetching rooms: {e}")
+        log_event(logging.ERROR, "fetch_rooms_failed", error=str(e))
         return []  # Return an empty list in case of an error
 
 def create_room_document(user ,name):
-    room_ref = firestore_db.collection('rooms').document(name)
-    room = {
-        'name': name,
-        'days': [],
-        "user_id": user
-    }
-    room_ref.set(room)
-    return room_ref
-
-def create_day_document(room, date):
-    day_ref = room.collection("days").document(date)
-    day = {
-        'date': date,
-        'bookings': []
-    }
-    day_ref.set(day)
-    return day_ref
+    room = repository.create_room(user, name)
+    read_cache.invalidate('rooms', 'dashboard')
+    return room
 
 def create_booking_document(room_name, date, booking_info):
     try:
-        # Get room reference
-        room_ref = firestore_db.collection('rooms').document(room_name)
-
-        # Get day reference
-        day_ref = room_ref.collection("days").document(date)
+        booking_info['start_time'], booking_info['end_time'] = normalize_booking_times(booking_info['start_time'], booking_info['end_time'])
 
-        if not day_ref.get().exists:
-            day_ref.set({'date': date, 'bookings': []})
+        # The repository checks the day's intervals and writes the booking atomically,
+        # so two reservations of the same slot cannot both succeed
+        conflict = repository.create_booking(room_name, date, booking_info)
+        if conflict:
+            return False, f"Room '{room_name}' is already booked from {conflict['start']} to {conflict['end']} on {date}."
 
-        booking = day_ref.collection("bookings").document()
-        booking.set(booking_info)
+        # Booking counts and dates are only shown from the dashboard; the cached room list has no use for them
+        read_cache.invalidate('dashboard')
 
         return True, "Booking added successfully."
     except Exception as e:
         # Handle error if booking could not be added
         return False, f"Failed to add booking: {str(e)}"
 
+def parse_bulk_upload(filename, content):
+    # Reads a list of bookings from a JSON array or a CSV file with a header row
+    fields = ['room_name', 'date', 'start_time', 'end_time']
+    try:
+        text = content.decode("utf-8-sig")
+        if filename.endswith(".json") or text.lstrip().startswith("["):
+            rows = json.loads(text)
+        else:
+            rows = list(csv.DictReader(io.StringIO(text)))
+        return [{field: str(row[field]).strip() for field in fields} for row in rows]
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not read bookings from upload: {e}")
+
+def expand_recurrence(room_name, date, start_time, end_time, frequency, count):
+    # One booking per occurrence, starting on `date`
+    steps = {'daily': timedelta(days=1), 'weekly': timedelta(weeks=1)}
+    if frequency not in steps or count < 1:
+        raise HTTPException(status_code=400, detail="Frequency must be 'daily' or 'weekly' and count at least 1")
+
+    # Check the size before expanding, so a huge count is rejected without building the list
+    if count > BULK_MAX_BOOKINGS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_BOOKINGS} bookings can be created at once")
+
+    try:
+        first_date = datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Date must be in the format YYYY-MM-DD")
+
+    try:
+        return [{
+            'room_name': room_name,
+            'date': (first_date + steps[frequency] * occurrence).isoformat(),
+            'start_time': start_time,
+            'end_time': end_time
+        } for occurrence in range(count)]
+    except OverflowError:
+        raise HTTPException(status_code=400, detail="The recurrence runs past the last supported date (9999-12-31)")
+
+def create_booking_documents(bookings):
+    """
+    Validates and writes many bookings at once.
+    Dates and times are checked here; the repository then checks every booking
+    against the existing intervals and the other new bookings before writing any.
+    Returns the list of validation errors, which is empty on success.
+    """
+    errors = []
+
+    for position, booking in enumerate(bookings):
+        try:
+            datetime.strptime(booking['date'], "%Y-%m-%d")
+            booking['start_time'], booking['end_time'] = normalize_booking_times(booking['start_time'], booking['end_time'])
+        except ValueError as e:
+            errors.append({'row': position, 'error': str(e)})
+    if errors:
+        return errors
+
+    try:
+        errors = repository.create_bookings(bookings)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        read_cache.invalidate('dashboard')
+
+    return errors
+
+async def api_listing(listing, order_fields, limit, cursor, format):
+    # Shared response for the /api listings: one JSON page, or everything after the cursor as NDJSON
+    if format == "ndjson":
+        # The cursor is checked before the response starts, so a bad one still gets a 400
+        cursor = decode_cursor(cursor, order_fields) if cursor else None
+        return StreamingResponse(stream_ndjson(listing, cursor), media_type="application/x-ndjson")
+
+    items, next_cursor = await run_blocking(fetch_page, listing, order_fields, cursor, limit)
+    return {"items": items, "next_cursor": next_cursor}
+
+def fetch_room_availability(date, window_start, window_end, duration):
+    rooms = fetch_all_rooms()
+
+    # Read the day of every room at once
+    intervals_by_day = repository.get_day_intervals([(room['name'], date) for room in rooms])
+
+    availability = []
+    for room in rooms:
+        free = find_free_windows(intervals_by_day.get((room['name'], date), []), time_to_minutes(window_start), time_to_minutes(window_end), duration)
+        availability.append({
+            'room_name': room['name'],
+            'free': [{'start': minutes_to_time(start), 'end': minutes_to_time(end)} for start, end in free]
+        })
+
+    return availability
+
+def find_free_windows(intervals, window_start, window_end, duration):
+    """
+    Sweeps a day's sorted intervals once and returns the (start, end) gaps, in
+    minutes, of at least `duration` minutes inside [window_start, window_end].
+    """
+    free = []
+    cursor = window_start
+
+    for interval in intervals:
+        start, end = time_to_minutes(interval['start']), time_to_minutes(interval['end'])
+        if end <= cursor:
+            continue
+        if start >= window_end:
+            break
+        if start - cursor >= duration:
+            free.append((cursor, start))
+        cursor = max(cursor, end)
+
+    if window_end - cursor >= duration:
+        free.append((cursor, window_end))
+
+    return free
+
+def time_to_minutes(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def minutes_to_time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def get_booking_document(booking_id):
+    return repository.get_booking(booking_id)
+
+def update_booking_document(booking_id, date, start_time, end_time):
+    """
+    Updates a booking's date and times, moving it to another day if the date changed.
+    Returns (booking data, conflicting interval): the booking is None if it does not
+    exist, and the interval is None unless the new slot is already taken.
+    Raises ValueError if the date or times are invalid.
+    """
+    datetime.strptime(date, "%Y-%m-%d")
+    start_time, end_time = normalize_booking_times(start_time, end_time)
+
+    result = repository.update_booking(booking_id, date, start_time, end_time)
+    read_cache.invalidate('dashboard')
+    return result
+
+def delete_booking_document(booking_id):
+    # Returns True if the booking was found and deleted, False otherwise
+    if not repository.delete_booking(booking_id):
+        return False
+
+    read_cache.invalidate('dashboard')
+    return True
+
 def get_user(user_token):
-    user = firestore_db.collection('users').document(user_token['user_id'])
-    if not user.get().exists:
-        user_data = {
-            'name': 'John Doe',
-            'address_list': []
-        }
-        firestore_db.collection('users').document(user_token['user_id']).set(user_data)
+    found, user = known_users.get(user_token['user_id'])
+    if found:
+        return user
 
+    user = repository.ensure_user(user_token['user_id'])
+    known_users.set(user_token['user_id'], user)
     return user
 
 def validate_firebase_token(id_token):
@@ -512,8 +1070,24 @@ def validate_firebase_token(id_token):
     user_token = None
 
     try:
-        user_token = google.oauth2.id_token.verify_firebase_token(id_token, firebase_request_adapter)
+        user_token = token_verifier.verify(id_token)
     except ValueError as err:
-        print(str(err))
+        log_event(logging.WARNING, "invalid_token", error=str(err))
+
+    return user_token
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance commands for the bookings API")
+    parser.add_argument("command", choices=["backfill-booking-projections", "migrate-booking-timestamps"])
+    args = parser.parse_args()
+
+    # Maintenance commands only exist on the Firestore backend
+    if not hasattr(repository, args.command.replace('-', '_')):
+        parser.error(f"{args.command} only applies to the firestore storage backend")
 
-    return user_token
\ No newline at end of file
+    if args.command == "backfill-booking-projections":
+        print(f"Indexed {repository.backfill_booking_projections()} bookings")
+    elif args.command == "migrate-booking-timestamps":
+        print(f"Added timestamps to {repository.migrate_booking_timestamps()} bookings")
@@ -0,0 +1,169 @@
+import email.utils
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.staticfiles import StaticFiles
+from starlette.responses import Response
+
+# Brotli is optional; without brotli-asgi responses are gzipped
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+
+class CompressResponses:
+    """
+    Compresses responses with brotli when brotli-asgi is installed and the client
+    accepts it, and with gzip otherwise. Paths under `skip_prefixes` are passed
+    through untouched: a compressor holds back a stream's events until enough
+    bytes have accumulated, which would stall server-sent events.
+    """
+
+    def __init__(self, app, minimum_size, skip_prefixes=()):
+        self.app = app
+        self.skip_prefixes = tuple(skip_prefixes)
+        if BrotliMiddleware is not None:
+            self.compressed_app = BrotliMiddleware(app, minimum_size=minimum_size)
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and not scope['path'].startswith(self.skip_prefixes):
+            await self.compressed_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+class StaticAssets:
+    """
+    Builds fingerprinted URLs for the files of a static directory. A file is hashed
+    the first time it is asked about; the files only change with a deploy, which
+    restarts the process.
+    """
+
+    def __init__(self, directory, mount_path):
+        self.directory = os.path.realpath(directory)
+        self.mount_path = mount_path.rstrip('/')
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def fingerprint(self, path):
+        path = path.lstrip('/')
+        with self._lock:
+            fingerprint = self._fingerprints.get(path)
+        if fingerprint is None:
+            with open(os.path.join(self.directory, path), 'rb') as file:
+                fingerprint = hashlib.sha256(file.read()).hexdigest()[:12]
+            with self._lock:
+                self._fingerprints[path] = fingerprint
+        return fingerprint
+
+    def url(self, path):
+        return f"{self.mount_path}/{path.lstrip('/')}?v={self.fingerprint(path)}"
+
+
+class FingerprintedStaticFiles(StaticFiles):
+    """
+    Static files requested with their current content hash (?v=...) never change
+    under that URL, so they are cached for `max_age` seconds without revalidation.
+    Plain URLs, and ones carrying any other hash, are revalidated.
+    """
+
+    def __init__(self, *args, assets, max_age, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.assets = assets
+        self.max_age = max_age
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        requested = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('v')
+        path = os.path.relpath(os.path.realpath(full_path), self.assets.directory)
+        if requested and requested[0] == self.assets.fingerprint(path):
+            response.headers['Cache-Control'] = f"public, max-age={self.max_age}, immutable"
+        else:
+            response.headers['Cache-Control'] = "no-cache"
+        return response
+
+
+def build_version(template_directory, assets):
+    """
+    A short hash of the templates and of every static file's fingerprint. Pages are
+    rendered from both, so their ETags include it: after a deploy that changes either,
+    a browser's cached page no longer matches and is sent again with the new asset URLs.
+    """
+    digest = hashlib.sha256()
+    for directory, hash_file in ((template_directory, None), (assets.directory, assets.fingerprint)):
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                relative_path = os.path.relpath(path, directory)
+                if hash_file is not None:
+                    fingerprint = hash_file(relative_path)
+                else:
+                    with open(path, 'rb') as file:
+                        fingerprint = hashlib.sha256(file.read()).hexdigest()
+                digest.update(f"{relative_path}:{fingerprint}\n".encode())
+    return digest.hexdigest()[:8]
+
+
+def content_version(data):
+    # A short hash of JSON-serializable data; equal data gives the same version in every worker
+    encoded = json.dumps(data, sort_keys=True, default=lambda value: value.isoformat() if hasattr(value, 'isoformat') else str(value))
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+
+class DataVersions:
+    """
+    The current version of each read model, with the time this worker first saw it.
+    The time serves as Last-Modified: it only moves when the data actually changes.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, data):
+        # Returns (version, modified_at) of freshly read data
+        version = content_version(data)
+        with self._lock:
+            current = self._versions.get(key)
+            if current is None or current[0] != version:
+                current = (version, datetime.now(timezone.utc).replace(microsecond=0))
+                self._versions[key] = current
+        return current
+
+
+def validator_headers(etag, last_modified=None):
+    # Per-user pages may be stored by the browser, but must be revalidated on every view
+    headers = {'ETag': etag, 'Cache-Control': "private, no-cache"}
+    if last_modified is not None:
+        headers['Last-Modified'] = email.utils.format_datetime(last_modified, usegmt=True)
+    return headers
+
+
+def is_not_modified(request, etag, last_modified=None):
+    # If-None-Match takes precedence over If-Modified-Since, as in RFC 9110
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # Weak comparison: a compressed copy is the same representation
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or etag.removeprefix('W/') in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return last_modified <= email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified(etag, last_modified=None):
+    return Response(status_code=304, headers=validator_headers(etag, last_modified))
@@ -0,0 +1,91 @@
+'use strict'
+
+// Keeps a /room-bookings or /filter-date page current from the /live/bookings event stream
+
+const container = document.getElementById('bookings')
+const room = container.dataset.liveRoom
+const date = container.dataset.liveDate
+
+function belongsHere(booking) {
+    return room ? booking.room_name === room : booking.date === date
+}
+
+function field(label, value) {
+    const element = document.createElement('div')
+    element.className = 'date'
+    const heading = document.createElement('h3')
+    heading.textContent = label
+    const text = document.createElement('p')
+    text.textContent = value
+    element.append(heading, ' ', text)
+    return element
+}
+
+function link(href, text, className) {
+    const element = document.createElement('a')
+    element.href = href
+    element.textContent = text
+    element.className = className
+    return element
+}
+
+function renderBooking(booking) {
+    // Same markup as bookings.html
+    const element = document.createElement('div')
+    element.className = 'booking'
+    element.dataset.id = booking.id
+    element.dataset.sortKey = `${booking.date} ${booking.start_time} ${booking.id}`
+
+    const buttons = document.createElement('div')
+    buttons.className = 'btns'
+    buttons.append(link(`/delete/booking/${encodeURIComponent(booking.id)}`, 'Delete', 'btn-delete'), ' ',
+                   link(`/edit/booking/${encodeURIComponent(booking.id)}`, 'Edit', 'btn-edit'))
+
+    element.append(field('Start Time:', booking.start_time), field('End time:', booking.end_time), buttons)
+    return element
+}
+
+function findBooking(id) {
+    return Array.from(container.children).find((element) => element.dataset.id === id)
+}
+
+function upsert(booking) {
+    const existing = findBooking(booking.id)
+    if (!belongsHere(booking)) {
+        remove(booking)
+        return
+    }
+
+    const element = renderBooking(booking)
+    if (existing) {
+        existing.replaceWith(element)
+    } else {
+        // Keep the list in date and start time order
+        const next = Array.from(container.children).find((other) => other.dataset.sortKey > element.dataset.sortKey)
+        container.insertBefore(element, next || null)
+    }
+    updateEmptyMessage()
+}
+
+function remove(booking) {
+    const existing = findBooking(booking.id)
+    if (existing) {
+        existing.remove()
+    }
+    updateEmptyMessage()
+}
+
+function updateEmptyMessage() {
+    const message = document.getElementById('no-bookings')
+    if (message) {
+        message.hidden = container.children.length > 0
+    }
+}
+
+const source = new EventSource(`/live/bookings?${new URLSearchParams(room ? { room } : { date })}`)
+
+// The snapshot only adds and refreshes: a listener that has just started may not have seen everything yet
+source.addEventListener('snapshot', (event) => JSON.parse(event.data).forEach(upsert))
+source.addEventListener('booking_added', (event) => upsert(JSON.parse(event.data)))
+source.addEventListener('booking_modified', (event) => upsert(JSON.parse(event.data)))
+source.addEventListener('booking_removed', (event) => remove(JSON.parse(event.data)))
@@ -0,0 +1,1413 @@
+import bisect
+import logging
+import os
+import random
+import secrets
+import threading
+from datetime import datetime, time, timedelta, timezone
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.rpc import code_pb2
+
+from instrumentation import instrument_firestore_client, log_event
+from local_constants import (STORAGE_BACKEND, FIRESTORE_PROJECT, ROOM_REMOVAL_LEASE_SECONDS, DASHBOARD_COUNTER_SHARDS,
+                             LISTING_BATCH_SIZE)
+
+# Field order of every bookings listing; listing cursors hold these values of the last row
+BOOKING_ORDER = ['date', 'start_time', 'id']
+DATE_BOOKING_ORDER = ['room_name', 'start_time', 'id']
+RANGE_BOOKING_ORDER = ['starts_at', 'room_name', 'id']
+
+def normalize_booking_times(start_time, end_time):
+    # Times are compared as zero-padded "HH:MM" strings; raises ValueError on bad input
+    start_time = datetime.strptime(start_time[:5], "%H:%M").strftime("%H:%M")
+    end_time = datetime.strptime(end_time[:5], "%H:%M").strftime("%H:%M")
+    if start_time >= end_time:
+        raise ValueError("The end time must be after the start time")
+    return start_time, end_time
+
+def booking_timestamps(date, start_time, end_time):
+    # Typed start and end of a booking, for range queries. Booking times carry no zone, so they are stored as UTC.
+    day = datetime.strptime(date, "%Y-%m-%d").date()
+    return (datetime.combine(day, time.fromisoformat(start_time), tzinfo=timezone.utc),
+            datetime.combine(day, time.fromisoformat(end_time), tzinfo=timezone.utc))
+
+def add_timestamps(booking):
+    # Sets starts_at and ends_at from the booking's date and "HH:MM" times
+    booking['starts_at'], booking['ends_at'] = booking_timestamps(booking['date'], booking['start_time'], booking['end_time'])
+    return booking
+
+def date_range(first_date, last_date):
+    # The [start, end) timestamps covering two "YYYY-MM-DD" dates, both included
+    start = datetime.strptime(first_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    end = datetime.strptime(last_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+    return start, end
+
+def range_cursor(cursor):
+    # Cursors travel as JSON, so starts_at comes back as a string
+    if cursor and isinstance(cursor.get('starts_at'), str):
+        return dict(cursor, starts_at=datetime.fromisoformat(cursor['starts_at']))
+    return cursor
+
+def find_conflicting_interval(intervals, start_time, end_time):
+    """
+    Returns an interval overlapping [start_time, end_time), or None.
+    Only intervals starting before end_time can overlap, found by binary search,
+    and of those the one ending last decides. Intervals written through this check
+    are disjoint, so that is the last of them, but days backfilled from older data
+    may hold overlapping bookings, so every one of them is compared.
+    """
+    position = bisect.bisect_left(intervals, end_time, key=lambda interval: interval['start'])
+    if position == 0:
+        return None
+    latest = max(intervals[:position], key=lambda interval: interval['end'])
+    return latest if latest['end'] > start_time else None
+
+def insert_interval(intervals, start_time, end_time, booking_id):
+    position = bisect.bisect_left(intervals, start_time, key=lambda interval: interval['start'])
+    intervals.insert(position, {'start': start_time, 'end': end_time, 'id': booking_id})
+
+def remove_interval(intervals, booking_id):
+    intervals[:] = [interval for interval in intervals if interval['id'] != booking_id]
+
+
+class RoomBeingRemoved(Exception):
+    """Raised when a booking is changed in a room whose removal has started."""
+
+
+class BookingRepository:
+    """
+    Storage interface used by the request handlers.
+
+    Rooms are keyed by name. Each room has days keyed by "YYYY-MM-DD", and each day
+    keeps its booked intervals, a list of {'start', 'end', 'id'} sorted by start,
+    plus a booking count. New bookings never overlap the intervals; only bookings
+    backfilled from before the intervals existed can overlap each other. Bookings are plain dicts with id,
+    room_name, date, start_time, end_time and booked_by. Times passed in are
+    already normalized to "HH:MM".
+
+    Listings return iterators of dicts. `cursor` is a dict of the order-by values
+    of the last row already seen, and `limit=None` returns everything after it.
+    """
+
+    # Backends that count their own reads, writes and queries set this, so a repository
+    # method that makes several storage calls is not counted as one
+    reports_storage_calls = False
+
+    # Rooms
+
+    def list_rooms(self):
+        raise NotImplementedError
+
+    def get_dashboard(self):
+        """
+        The landing page's read model: every room as {'name', 'user_id', 'booking_count'}
+        sorted by name, and the sorted dates that have at least one booking.
+        """
+        raise NotImplementedError
+
+    def get_room(self, name):
+        # The room's data, or None if it does not exist
+        raise NotImplementedError
+
+    def create_room(self, user_id, name):
+        # Raises ValueError if a room of that name exists; re-creating it would reset its booking count
+        raise NotImplementedError
+
+    def delete_room(self, name):
+        # Deletes an empty room; raises ValueError if it has bookings by the time it is deleted
+        raise NotImplementedError
+
+    def start_room_removal(self, name, archive=False):
+        """
+        Claims the removal of a room for one run and returns its lease, to pass to
+        remove_room. Raises ValueError while another run holds the lease, so a
+        repeated submit cannot start a second sweep of the same room.
+        A removal that failed part way is claimed again in its original mode.
+        """
+        raise NotImplementedError
+
+    def remove_room(self, name, lease, progress=None):
+        """
+        Deletes a room together with all its days and bookings, dropping the bookings'
+        index entries and projections and the room's share of the dashboard.
+        A removal started with archive=True first copies the room, its days and its
+        bookings under archived_rooms/{name}. `progress(processed, total)` is called as
+        bookings are removed. Returns the number of bookings removed.
+        A removal that fails part way releases its lease and can be claimed again to finish it.
+        """
+        raise NotImplementedError
+
+    def get_room_removal(self, name):
+        # {'room', 'archive', 'in_progress'} of a removal that started and has not finished, or None
+        return None
+
+    def room_has_bookings(self, name, room):
+        # Rooms keep a running booking count, so the room's data already answers this
+        return room.get('booking_count', 0) > 0
+
+    def resolve_rooms(self, room_names):
+        # Maps the names of existing rooms to their ids; missing rooms are left out
+        raise NotImplementedError
+
+    # Bookings
+
+    def create_booking(self, room_name, date, booking_info):
+        # Returns the conflicting interval, or None once the booking is stored.
+        # A booking whose id is already stored is a replayed submit and is not written again.
+        raise NotImplementedError
+
+    def get_booking(self, booking_id):
+        raise NotImplementedError
+
+    def update_booking(self, booking_id, date, start_time, end_time):
+        """
+        Moves a booking to a new date and times.
+        Returns (booking data, conflicting interval): the booking is None if it does
+        not exist, and the interval is None unless the new slot is already taken.
+        Raises RoomBeingRemoved if the booking's room is being removed.
+        """
+        raise NotImplementedError
+
+    def delete_booking(self, booking_id):
+        # Returns True if the booking was found and deleted, False otherwise.
+        # Raises RoomBeingRemoved if the booking's room is being removed; its removal deletes the booking.
+        raise NotImplementedError
+
+    def get_bookings_for_room(self, room_name, user_id):
+        # A user's bookings of one room
+        raise NotImplementedError
+
+    def get_bookings_on_date(self, room_names, date):
+        # Every booking of the given rooms on one "YYYY-MM-DD" date, from the one listing of every room's bookings that day
+        wanted = set(room_names)
+        return [booking for booking in self.iter_bookings_on_date(date) if booking['room_name'] in wanted]
+
+    def get_day_intervals(self, days, versions=None):
+        """
+        Maps each (room id, date) pair to that day's sorted intervals. A `versions` dict
+        is filled with each day's version as read (None for days without a document),
+        so write_bookings can tell whether a day changed since.
+        """
+        raise NotImplementedError
+
+    def create_bookings(self, bookings):
+        """
+        Validates and stores many bookings at once.
+        Every booking is checked against the existing intervals of its day and
+        against the other new bookings before anything is written. Returns a list
+        of {'row', 'error'} dicts, which is empty once everything is stored.
+        If a day changes between the check and the write, its rows are left out and
+        reported with 'retry': True; the other days' bookings are stored.
+        """
+        errors = []
+
+        room_ids = self.resolve_rooms([booking['room_name'] for booking in bookings])
+        for position, booking in enumerate(bookings):
+            if booking['room_name'] not in room_ids:
+                errors.append({'row': position, 'error': f"Room '{booking['room_name']}' does not exist"})
+        if errors:
+            return errors
+
+        days = list(dict.fromkeys((room_ids[booking['room_name']], booking['date']) for booking in bookings))
+        day_versions = {}
+        intervals_by_day = self.get_day_intervals(days, day_versions)
+
+        new_bookings_by_day = {}
+        for position, booking in enumerate(bookings):
+            key = (room_ids[booking['room_name']], booking['date'])
+            intervals = intervals_by_day.setdefault(key, [])
+
+            conflict = find_conflicting_interval(intervals, booking['start_time'], booking['end_time'])
+            if conflict:
+                errors.append({'row': position, 'error': f"Room '{booking['room_name']}' is already booked from {conflict['start']} to {conflict['end']} on {booking['date']}"})
+                continue
+
+            insert_interval(intervals, booking['start_time'], booking['end_time'], booking['id'])
+            new_bookings_by_day.setdefault(key, []).append(booking)
+        if errors:
+            return errors
+
+        for booking in bookings:
+            add_timestamps(booking)
+        unwritten = set(self.write_bookings(new_bookings_by_day, intervals_by_day, day_versions))
+        for position, booking in enumerate(bookings):
+            if booking['id'] in unwritten:
+                errors.append({'row': position, 'retry': True,
+                               'error': f"Room '{booking['room_name']}' was booked on {booking['date']} while the import was written; not created"})
+        return errors
+
+    def write_bookings(self, new_bookings_by_day, intervals_by_day, day_versions):
+        """
+        Stores already validated bookings grouped by (room id, date) with each day's new intervals.
+        Days whose version no longer matches `day_versions` are not written; returns
+        the ids of their bookings.
+        """
+        raise NotImplementedError
+
+    # Listings
+
+    def iter_rooms(self, cursor=None, limit=None):
+        # Rooms ordered by name
+        raise NotImplementedError
+
+    def iter_user_bookings(self, user_id, room_name=None, cursor=None, limit=None):
+        # A user's bookings ordered by BOOKING_ORDER, optionally of one room only
+        raise NotImplementedError
+
+    def iter_bookings_on_date(self, date, cursor=None, limit=None):
+        # Every room's bookings on one date, ordered by DATE_BOOKING_ORDER
+        raise NotImplementedError
+
+    def iter_bookings_in_range(self, start, end, room_name=None, cursor=None, limit=None):
+        # Bookings starting in [start, end), optionally of one room, ordered by RANGE_BOOKING_ORDER
+        raise NotImplementedError
+
+    # Users
+
+    def ensure_user(self, user_id):
+        # The user's profile, created with defaults on first sight
+        raise NotImplementedError
+
+    # Change events
+
+    def watch(self, callback):
+        """
+        Calls `callback` with a {'type', 'data'} event for every room and booking
+        change: room_added, room_modified, room_removed and the booking_ equivalents,
+        starting with an 'added' event for everything that already exists.
+        The callback may run on another thread and must not block.
+        Returns a function that stops watching.
+        """
+        raise NotImplementedError
+
+
+class FirestoreRepository(BookingRepository):
+    """
+    Stores everything in Firestore:
+
+    - rooms/{name}/days/{date}/bookings/{booking_id} holds the bookings themselves,
+    - booking_index/{booking_id} points a booking id at its room and day,
+    - users/{uid}/user_bookings/{booking_id} is a copy of each user's bookings.
+
+    The client is created on first use, so importing the app needs neither
+    credentials nor network. It honours FIRESTORE_EMULATOR_HOST.
+    """
+
+    reports_storage_calls = True
+
+    def __init__(self, project=None):
+        self.project = project
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # Every request the client sends is counted, including get_all and BulkWriter batches
+                    self._client = instrument_firestore_client(firestore.Client(project=self.project))
+        return self._client
+
+    def _room_ref(self, name):
+        return self.client.collection('rooms').document(name)
+
+    def _day_ref(self, room_id, date):
+        return self._room_ref(room_id).collection('days').document(date)
+
+    def _user_booking_ref(self, user_id, booking_id):
+        # Each user keeps a denormalized copy of their bookings, keyed by booking id
+        return self.client.collection('users').document(user_id).collection('user_bookings').document(booking_id)
+
+    def _index_ref(self, booking_id):
+        return self.client.collection('booking_index').document(booking_id)
+
+    def _removal_ref(self, name):
+        # Marks a room whose removal has started and not yet finished; holds the room's data
+        return self.client.collection('room_removals').document(name)
+
+    def _dashboard_ref(self):
+        # One denormalized document per deployment, updated by every room write
+        return self.client.collection('dashboard').document('main')
+
+    def _dashboard_counts_ref(self, shard=None):
+        # Booking writes add their count changes to one of several shards, picked at random,
+        # so concurrent reservations do not all contend for the same document
+        if shard is None:
+            shard = random.randrange(DASHBOARD_COUNTER_SHARDS)
+        return self._dashboard_ref().collection('counts').document(str(shard))
+
+    @staticmethod
+    def _dashboard_changes(room_counts, date_counts):
+        # A merge write adding booking count changes to a counts shard's rooms and dates.
+        # Empty maps are left out, since merging {} would clear the whole field.
+        changes = {}
+        if room_counts:
+            changes['rooms'] = {room: firestore.Increment(count) for room, count in room_counts.items()}
+        if date_counts:
+            changes['dates'] = {date: firestore.Increment(count) for date, count in date_counts.items()}
+        return changes
+
+    def _drop_dashboard_room(self, writer, name):
+        # Takes a room and its booking counts off the dashboard, through a transaction, batch or bulk writer
+        writer.set(self._dashboard_ref(), {'rooms': {name: firestore.DELETE_FIELD}}, merge=True)
+        for shard in range(DASHBOARD_COUNTER_SHARDS):
+            writer.set(self._dashboard_counts_ref(shard), {'rooms': {name: firestore.DELETE_FIELD}}, merge=True)
+
+    @staticmethod
+    def _index_entry(room_name, date, booked_by):
+        # The index entry points a booking id at the room and day holding it; the document key is the id itself
+        return {
+            'room_name': room_name,
+            'date': date,
+            'booked_by': booked_by
+        }
+
+    @staticmethod
+    def _day_intervals(day_snapshot):
+        if not day_snapshot.exists:
+            return []
+        return day_snapshot.to_dict().get('intervals', [])
+
+    def _bulk_writer(self, failures):
+        # A BulkWriter that retries transient failures a few times, then records them in `failures`.
+        # Failed preconditions are recorded straight away: retrying cannot make them pass.
+        def on_write_error(error, bulk_writer):
+            if error.code not in (code_pb2.ALREADY_EXISTS, code_pb2.FAILED_PRECONDITION) and error.attempts < 3:
+                return True
+            failures.append(error)
+            return False
+
+        bulk_writer = self.client.bulk_writer()
+        bulk_writer.on_write_error(on_write_error)
+        return bulk_writer
+
+    def _get_booking_reference(self, booking_id):
+        """
+        Resolves a booking id through the booking index.
+        Returns the booking document reference and the index snapshot, or (None, None).
+        """
+        index_entry = self._index_ref(booking_id).get()
+        if not index_entry.exists:
+            return None, None
+
+        # Bookings created before ids became document keys keep their auto-id in booking_doc_id
+        entry = index_entry.to_dict()
+        booking_ref = self._day_ref(entry['room_name'], entry['date']).collection('bookings').document(entry.get('booking_doc_id', booking_id))
+        return booking_ref, index_entry
+
+    def _resolve_room_references(self, room_names):
+        """
+        Resolves room names to their document references in one get_all round trip.
+        Rooms are keyed by name; any stored under another id are found by their
+        'name' field instead. Names of rooms that do not exist are left out.
+        """
+        rooms_ref = self.client.collection('rooms')
+        unique_names = list(dict.fromkeys(room_names))
+
+        resolved = {}
+        for room_doc in self.client.get_all([rooms_ref.document(name) for name in unique_names]):
+            if room_doc.exists:
+                resolved[room_doc.id] = room_doc.reference
+
+        # 'in' filters accept at most 30 values
+        missing = [name for name in unique_names if name not in resolved]
+        for position in range(0, len(missing), 30):
+            for room_doc in rooms_ref.where(filter=FieldFilter('name', 'in', missing[position:position + 30])).stream():
+                resolved[room_doc.get('name')] = room_doc.reference
+
+        return resolved
+
+    # Rooms
+
+    def list_rooms(self):
+        return [doc.to_dict() for doc in self.client.collection("rooms").get()]
+
+    def get_dashboard(self):
+        dashboard = self._dashboard_ref().get()
+        if not dashboard.exists:
+            # Every room write merges into the dashboard, so only a database without rooms lacks it. Rooms
+            # created before it existed only appear once backfill-booking-projections has run;
+            # a fallback here would stop working at the first write, which creates a partial one.
+            log_event(logging.WARNING, "dashboard_missing",
+                      hint="run backfill-booking-projections if this database already has rooms")
+            return {'rooms': [], 'dates': []}
+
+        # The main document lists the rooms; its counts, as last rebuilt by the backfill,
+        # are added to the changes collected in the counts shards since
+        data = dashboard.to_dict()
+        room_counts = {name: summary.get('booking_count', 0) for name, summary in data.get('rooms', {}).items()}
+        date_counts = dict(data.get('dates', {}))
+        for shard in self._dashboard_ref().collection('counts').stream():
+            counts = shard.to_dict()
+            for name, count in counts.get('rooms', {}).items():
+                if name in room_counts:
+                    room_counts[name] += count
+            for date, count in counts.get('dates', {}).items():
+                date_counts[date] = date_counts.get(date, 0) + count
+
+        return {'rooms': [{'name': name, 'user_id': summary.get('user_id'), 'booking_count': room_counts[name]}
+                          for name, summary in sorted(data.get('rooms', {}).items())],
+                'dates': sorted(date for date, count in date_counts.items() if count > 0)}
+
+    def get_room(self, name):
+        room_doc = self._room_ref(name).get()
+        return room_doc.to_dict() if room_doc.exists else None
+
+    def create_room(self, user_id, name):
+        room = {
+            'name': name,
+            'days': [],
+            "user_id": user_id,
+            'booking_count': 0
+        }
+        @firestore.transactional
+        def create(transaction):
+            # The name stays taken until an unfinished removal of the old room completes
+            if self._removal_ref(name).get(transaction=transaction).exists:
+                raise ValueError(f"Room '{name}' is still being removed")
+            # create() fails if the room exists, and with it the whole transaction
+            transaction.create(self._room_ref(name), room)
+            transaction.set(self._dashboard_ref(), {'rooms': {name: {'user_id': user_id}}}, merge=True)
+
+        try:
+            create(self.client.transaction())
+        except AlreadyExists:
+            raise ValueError(f"Room '{name}' already exists")
+        return room
+
+    def delete_room(self, name):
+        room_ref = self._room_ref(name)
+
+        # Check the count and delete in one transaction: reservations update the room
+        # document in theirs, so one committed after the check aborts this delete
+        @firestore.transactional
+        def delete(transaction):
+            room_snapshot = room_ref.get(transaction=transaction)
+            if room_snapshot.exists and self.room_has_bookings(name, room_snapshot.to_dict()):
+                raise ValueError(f"Room '{name}' has bookings")
+            transaction.delete(room_ref)
+            self._drop_dashboard_room(transaction, name)
+
+        delete(self.client.transaction())
+
+    @staticmethod
+    def _lease_held(removal):
+        # Whether a run of the removal holds an unexpired lease
+        running_until = removal.get('running_until')
+        return running_until is not None and running_until > datetime.now(timezone.utc)
+
+    def get_room_removal(self, name):
+        removal = self._removal_ref(name).get()
+        if not removal.exists:
+            return None
+        removal = removal.to_dict()
+        return {'room': removal['room'], 'archive': removal['archive'], 'in_progress': self._lease_held(removal)}
+
+    def start_room_removal(self, name, archive=False):
+        room_ref = self._room_ref(name)
+        removal_ref = self._removal_ref(name)
+        lease = secrets.token_hex(8)
+        running_until = datetime.now(timezone.utc) + timedelta(seconds=ROOM_REMOVAL_LEASE_SECONDS)
+
+        @firestore.transactional
+        def claim(transaction):
+            removal_snapshot = removal_ref.get(transaction=transaction)
+            room_snapshot = room_ref.get(transaction=transaction)
+            if removal_snapshot.exists:
+                # A resumed removal finishes the way it was started
+                if self._lease_held(removal_snapshot.to_dict()):
+                    raise ValueError(f"Room '{name}' is already being removed")
+                transaction.update(removal_ref, {'lease': lease, 'running_until': running_until})
+                return
+            if not room_snapshot.exists:
+                raise ValueError(f"Room '{name}' does not exist")
+
+            # The room document goes first: reservations update it and booking moves and deletes
+            # read it in their transaction, so once it is gone no booking enters or leaves the subtree being removed.
+            # The marker written in its place stays until the subtree is gone.
+            room = room_snapshot.to_dict()
+            transaction.set(removal_ref, {'room': room, 'archive': archive, 'started_at': firestore.SERVER_TIMESTAMP,
+                                          'lease': lease, 'running_until': running_until})
+            if archive:
+                transaction.set(self.client.collection('archived_rooms').document(name),
+                                dict(room, archived_at=firestore.SERVER_TIMESTAMP))
+            transaction.delete(room_ref)
+            self._drop_dashboard_room(transaction, name)
+
+        claim(self.client.transaction())
+        return lease
+
+    def _renew_removal_lease(self, name, lease, running_until):
+        """
+        Moves the lease's expiry to `running_until`, or clears it when None.
+        Raises RuntimeError if another run took the lease over in the meantime.
+        """
+        removal_ref = self._removal_ref(name)
+
+        @firestore.transactional
+        def renew(transaction):
+            removal = removal_ref.get(transaction=transaction)
+            if not removal.exists or removal.get('lease') != lease:
+                raise RuntimeError(f"The removal of room '{name}' was taken over by another run")
+            transaction.update(removal_ref, {'running_until': running_until})
+
+        renew(self.client.transaction())
+
+    def remove_room(self, name, lease, progress=None):
+        try:
+            return self._sweep_room(name, lease, progress)
+        except Exception:
+            # Release the lease, so the removal can be resumed straight away
+            try:
+                self._renew_removal_lease(name, lease, None)
+            except Exception as e:
+                log_event(logging.WARNING, "room_removal_lease_not_released", room=name, error=str(e))
+            raise
+
+    def _sweep_room(self, name, lease, progress):
+        removal = self.get_room_removal(name)
+        if removal is None:
+            return 0
+        room_ref = self._room_ref(name)
+        room = removal['room']
+        archive = removal['archive']
+        total = room.get('booking_count') or 0
+        # The archive uses its own subcollection ids, so collection group queries on
+        # 'days' and 'bookings' never pick up archived documents
+        archive_ref = self.client.collection('archived_rooms').document(name) if archive else None
+
+        # Walk the subtree by hand rather than with recursive_delete, since every
+        # booking's index entry and projection have to go with it
+        failures = []
+        bulk_writer = self._bulk_writer(failures)
+        processed = 0
+        days = []
+        queued = 0
+
+        def remove_days(days):
+            # Keep the lease while the sweep goes on, and stop before touching anything if
+            # another run has taken it. Each group's dashboard counts are written with it,
+            # so a run that stops later has applied exactly the bookings it deleted.
+            self._renew_removal_lease(name, lease, datetime.now(timezone.utc) + timedelta(seconds=ROOM_REMOVAL_LEASE_SECONDS))
+            date_counts = {}
+            removed = self._remove_days(days, archive_ref, bulk_writer, failures, date_counts)
+            changes = self._dashboard_changes({}, date_counts)
+            if changes:
+                bulk_writer.set(self._dashboard_counts_ref(), changes, merge=True)
+            return removed
+
+        try:
+            # list_documents() also returns days deleted by an earlier attempt that still hold bookings
+            for day_ref in room_ref.collection('days').list_documents():
+                booking_docs = list(day_ref.collection('bookings').stream())
+                days.append((day_ref, booking_docs))
+                queued += len(booking_docs)
+                if queued >= 500:
+                    processed += remove_days(days)
+                    days, queued = [], 0
+                    if progress:
+                        progress(processed, max(total, processed))
+            if days:
+                processed += remove_days(days)
+        finally:
+            # Sends the dashboard counts of the groups already removed, even when stopping early
+            bulk_writer.close()
+
+        if failures:
+            raise RuntimeError(f"{len(failures)} writes failed while removing room '{name}', run it again to resume: {failures[0].message}")
+
+        self._finish_room_removal(name, lease)
+        if progress:
+            progress(processed, processed)
+        return processed
+
+    def _finish_room_removal(self, name, lease):
+        # Drops the marker, unless another run took the removal over
+        removal_ref = self._removal_ref(name)
+
+        @firestore.transactional
+        def finish(transaction):
+            removal = removal_ref.get(transaction=transaction)
+            if removal.exists and removal.get('lease') != lease:
+                raise RuntimeError(f"The removal of room '{name}' was taken over by another run")
+            transaction.delete(removal_ref)
+
+        finish(self.client.transaction())
+
+    def _remove_days(self, days, archive_ref, bulk_writer, failures, date_counts):
+        """
+        Removes a group of (day reference, booking snapshots) of a room being removed,
+        returning the number of bookings deleted. Every step is flushed, and only what
+        the previous step wrote moves on: a booking is deleted after its archive copy,
+        index entry and projection are settled, and a day after all its bookings.
+        Whatever fails stays in the room's subtree for a resumed removal to find.
+        """
+        bookings = [(day_ref, booking_doc) for day_ref, booking_docs in days for booking_doc in booking_docs]
+        kept_days = set()
+
+        if archive_ref is not None:
+            archived_days = archive_ref.collection('archived_days')
+            start = len(failures)
+            for day_doc in self.client.get_all([day_ref for day_ref, _ in days]):
+                if day_doc.exists:
+                    bulk_writer.set(archived_days.document(day_doc.id), day_doc.to_dict())
+            for day_ref, booking_doc in bookings:
+                bulk_writer.set(archived_days.document(day_ref.id).collection('archived_bookings').document(booking_doc.id),
+                                booking_doc.to_dict())
+            bulk_writer.flush()
+            failed = self._failed_paths(failures, start)
+            kept_days.update(day_ref.id for day_ref, _ in days if archived_days.document(day_ref.id).path in failed)
+            bookings = [(day_ref, booking_doc) for day_ref, booking_doc in bookings
+                        if archived_days.document(day_ref.id).collection('archived_bookings').document(booking_doc.id).path not in failed]
+
+        start = len(failures)
+        for _, booking_doc in bookings:
+            booking = booking_doc.to_dict()
+            if booking.get('id'):
+                bulk_writer.delete(self._index_ref(booking['id']))
+                if booking.get('booked_by'):
+                    bulk_writer.delete(self._user_booking_ref(booking['booked_by'], booking['id']))
+        bulk_writer.flush()
+        failed = self._failed_paths(failures, start)
+        if failed:
+            bookings = [(day_ref, booking_doc) for day_ref, booking_doc in bookings
+                        if not self._booking_copies_failed(booking_doc.to_dict(), failed)]
+
+        start = len(failures)
+        for _, booking_doc in bookings:
+            bulk_writer.delete(booking_doc.reference)
+        bulk_writer.flush()
+        failed = self._failed_paths(failures, start)
+        bookings = [(day_ref, booking_doc) for day_ref, booking_doc in bookings if booking_doc.reference.path not in failed]
+
+        deleted = {}
+        for day_ref, _ in bookings:
+            deleted[day_ref.id] = deleted.get(day_ref.id, 0) + 1
+        for day_ref, booking_docs in days:
+            if day_ref.id not in kept_days and deleted.get(day_ref.id, 0) == len(booking_docs):
+                bulk_writer.delete(day_ref)
+            if deleted.get(day_ref.id):
+                date_counts[day_ref.id] = date_counts.get(day_ref.id, 0) - deleted[day_ref.id]
+        return len(bookings)
+
+    def _booking_copies_failed(self, booking, failed):
+        # Whether deleting the booking's index entry or projection failed
+        if not booking.get('id'):
+            return False
+        paths = {self._index_ref(booking['id']).path}
+        if booking.get('booked_by'):
+            paths.add(self._user_booking_ref(booking['booked_by'], booking['id']).path)
+        return not paths.isdisjoint(failed)
+
+    @staticmethod
+    def _failed_paths(failures, start):
+        # Paths of the documents whose writes failed since failures had `start` entries
+        return {failure.operation.reference.path for failure in failures[start:]}
+
+    def resolve_rooms(self, room_names):
+        return {name: room_ref.id for name, room_ref in self._resolve_room_references(room_names).items()}
+
+    # Bookings
+
+    def create_booking(self, room_name, date, booking_info):
+        day_ref = self._day_ref(room_name, date)
+        booking_ref = day_ref.collection("bookings").document(booking_info['id'])
+        index_ref = self._index_ref(booking_info['id'])
+        start_time, end_time = booking_info['start_time'], booking_info['end_time']
+        booking_info['starts_at'], booking_info['ends_at'] = booking_timestamps(date, start_time, end_time)
+
+        # Check the day's intervals and write everything in one transaction, so two
+        # reservations of the same slot cannot both succeed
+        @firestore.transactional
+        def reserve(transaction):
+            # An id that is already indexed means this submit was replayed; the booking stands as it is
+            if index_ref.get(transaction=transaction).exists:
+                return None
+            intervals = self._day_intervals(day_ref.get(transaction=transaction))
+
+            conflict = find_conflicting_interval(intervals, start_time, end_time)
+            if conflict:
+                return conflict
+            insert_interval(intervals, start_time, end_time, booking_info['id'])
+
+            # Write the day, the booking, its index entry, the owner's projection and the counters together
+            transaction.set(day_ref, {'date': date, 'intervals': intervals, 'booking_count': firestore.Increment(1)}, merge=True)
+            transaction.update(day_ref.parent.parent, {'booking_count': firestore.Increment(1)})
+            transaction.set(self._dashboard_counts_ref(), self._dashboard_changes({room_name: 1}, {date: 1}), merge=True)
+            transaction.set(booking_ref, booking_info)
+            transaction.set(index_ref, self._index_entry(room_name, date, booking_info['booked_by']))
+            transaction.set(self._user_booking_ref(booking_info['booked_by'], booking_info['id']), booking_info)
+            return None
+
+        return reserve(self.client.transaction())
+
+    def get_booking(self, booking_id):
+        # Look up the booking's room and day in the booking index, then read the booking
+        booking_ref, index_entry = self._get_booking_reference(booking_id)
+        if booking_ref is None:
+            return None
+
+        booking_document = booking_ref.get()
+        return booking_document.to_dict() if booking_document.exists else None
+
+    def update_booking(self, booking_id, date, start_time, end_time):
+        booking_ref, index_entry = self._get_booking_reference(booking_id)
+        if booking_ref is None:
+            return None, None
+
+        room_name = index_entry.get('room_name')
+        old_day_ref = booking_ref.parent.parent
+        room_ref = old_day_ref.parent.parent
+        new_day_ref = self._day_ref(room_name, date)
+        moving = date != index_entry.get('date')
+
+        @firestore.transactional
+        def move(transaction):
+            # All reads happen before any write in a transaction
+            booking_document = booking_ref.get(transaction=transaction)
+            if not booking_document.exists:
+                return None, None
+            # A removal deletes the room document first; reading it here keeps the booking
+            # from moving into a day the removal's sweep has already passed
+            if not room_ref.get(transaction=transaction).exists:
+                raise RoomBeingRemoved(f"Room '{room_name}' is being removed")
+            old_intervals = self._day_intervals(old_day_ref.get(transaction=transaction))
+            new_intervals = self._day_intervals(new_day_ref.get(transaction=transaction)) if moving else old_intervals
+
+            # Take the booking's own interval out before checking the new slot
+            remove_interval(old_intervals, booking_id)
+            conflict = find_conflicting_interval(new_intervals, start_time, end_time)
+            if conflict:
+                return booking_document.to_dict(), conflict
+            insert_interval(new_intervals, start_time, end_time, booking_id)
+
+            booking_data = booking_document.to_dict()
+            booking_data['start_time'] = start_time
+            booking_data['end_time'] = end_time
+            booking_data['date'] = date
+            add_timestamps(booking_data)
+
+            if not moving:
+                # Same day: update the booking in place
+                transaction.update(booking_ref, booking_data)
+                transaction.set(old_day_ref, {'intervals': old_intervals}, merge=True)
+            else:
+                # The date changed, so the booking moves to the new day's subcollection
+                new_booking_ref = new_day_ref.collection('bookings').document(booking_id)
+
+                transaction.set(new_day_ref, {'date': date, 'intervals': new_intervals, 'booking_count': firestore.Increment(1)}, merge=True)
+                transaction.set(new_booking_ref, booking_data)
+                transaction.set(old_day_ref, {'intervals': old_intervals, 'booking_count': firestore.Increment(-1)}, merge=True)
+                transaction.delete(booking_ref)
+                transaction.set(index_entry.reference, self._index_entry(room_name, date, booking_data['booked_by']))
+                transaction.set(self._dashboard_counts_ref(), self._dashboard_changes({}, {index_entry.get('date'): -1, date: 1}), merge=True)
+
+            # Keep the owner's projection in step with the booking
+            transaction.set(self._user_booking_ref(booking_data['booked_by'], booking_id), booking_data)
+            return booking_data, None
+
+        return move(self.client.transaction())
+
+    def delete_booking(self, booking_id):
+        booking_ref, index_entry = self._get_booking_reference(booking_id)
+        if booking_ref is None:
+            return False
+
+        day_ref = booking_ref.parent.parent
+        room_ref = day_ref.parent.parent
+
+        @firestore.transactional
+        def delete(transaction):
+            # The index was read outside the transaction; a concurrent delete of the same
+            # booking may have won since, and must not decrement the counters a second time
+            if not booking_ref.get(transaction=transaction).exists:
+                return False
+            # The removal of the room deletes the booking and takes it off the dashboard itself
+            room_snapshot = room_ref.get(transaction=transaction)
+            if not room_snapshot.exists:
+                raise RoomBeingRemoved(f"Room '{room_ref.id}' is being removed")
+            day_snapshot = day_ref.get(transaction=transaction)
+            intervals = self._day_intervals(day_snapshot)
+            remove_interval(intervals, booking_id)
+
+            # Delete the booking, free its slot, update the counters and drop its index entry and the owner's projection together
+            transaction.delete(booking_ref)
+            if day_snapshot.exists:
+                transaction.update(day_ref, {'intervals': intervals, 'booking_count': firestore.Increment(-1)})
+            transaction.update(room_ref, {'booking_count': firestore.Increment(-1)})
+            transaction.set(self._dashboard_counts_ref(), self._dashboard_changes({room_ref.id: -1}, {index_entry.get('date'): -1}), merge=True)
+            transaction.delete(index_entry.reference)
+            if index_entry.get('booked_by'):
+                transaction.delete(self._user_booking_ref(index_entry.get('booked_by'), booking_id))
+            return True
+
+        return delete(self.client.transaction())
+
+    def get_bookings_for_room(self, room_name, user_id):
+        # One collection group query instead of one query per day of the room
+        query = (self.client.collection_group('bookings')
+                 .where(filter=FieldFilter('room_name', '==', room_name))
+                 .where(filter=FieldFilter('booked_by', '==', user_id)))
+        return [booking_doc.to_dict() for booking_doc in query.stream()]
+
+    def get_day_intervals(self, days, versions=None):
+        # Read every day document in a single round trip; a day's version is its update time
+        intervals_by_day = {}
+        for day_snapshot in self.client.get_all([self._day_ref(room_id, date) for room_id, date in days]):
+            key = (day_snapshot.reference.parent.parent.id, day_snapshot.id)
+            intervals_by_day[key] = self._day_intervals(day_snapshot)
+            if versions is not None:
+                versions[key] = day_snapshot.update_time if day_snapshot.exists else None
+        return intervals_by_day
+
+    def write_bookings(self, new_bookings_by_day, intervals_by_day, day_versions):
+        """
+        Writes validated bookings through a BulkWriter, in two rounds. First each day
+        gets its new intervals and count, on the condition that it is unchanged since
+        it was read: an update with the read update time as precondition, or a create
+        for days that had no document. A reservation committed in between fails that
+        condition instead of having its interval overwritten. Then the bookings of
+        the days written, their index entries, projections and counters follow.
+        """
+        failures = []
+        bulk_writer = self._bulk_writer(failures)
+
+        day_refs = {}
+        for (room_id, date), day_bookings in new_bookings_by_day.items():
+            day_ref = day_refs[(room_id, date)] = self._day_ref(room_id, date)
+            intervals = intervals_by_day[(room_id, date)]
+            version = day_versions.get((room_id, date))
+            if version is None:
+                bulk_writer.create(day_ref, {'date': date, 'intervals': intervals, 'booking_count': len(day_bookings)})
+            else:
+                bulk_writer.update(day_ref, {'intervals': intervals, 'booking_count': firestore.Increment(len(day_bookings))},
+                                   option=self.client.write_option(last_update_time=version))
+        bulk_writer.flush()
+
+        # Days that lost the race keep what the concurrent reservation wrote, and the import skips them
+        stale_paths = {failure.operation.reference.path for failure in failures
+                       if failure.code in (code_pb2.ALREADY_EXISTS, code_pb2.FAILED_PRECONDITION)}
+        failures[:] = [failure for failure in failures if failure.operation.reference.path not in stale_paths]
+        unwritten = []
+
+        room_counts = {}
+        date_counts = {}
+        for (room_id, date), day_bookings in new_bookings_by_day.items():
+            day_ref = day_refs[(room_id, date)]
+            if day_ref.path in stale_paths:
+                unwritten.extend(booking['id'] for booking in day_bookings)
+                continue
+            room_counts[room_id] = room_counts.get(room_id, 0) + len(day_bookings)
+            date_counts[date] = date_counts.get(date, 0) + len(day_bookings)
+
+            for booking in day_bookings:
+                bulk_writer.set(day_ref.collection('bookings').document(booking['id']), booking)
+                bulk_writer.set(self._index_ref(booking['id']), self._index_entry(room_id, date, booking['booked_by']))
+                bulk_writer.set(self._user_booking_ref(booking['booked_by'], booking['id']), booking)
+
+        for room_id, booking_count in room_counts.items():
+            bulk_writer.update(self._room_ref(room_id), {'booking_count': firestore.Increment(booking_count)})
+        if room_counts:
+            bulk_writer.set(self._dashboard_counts_ref(), self._dashboard_changes(room_counts, date_counts), merge=True)
+
+        bulk_writer.close()
+
+        if failures:
+            raise RuntimeError(f"{len(failures)} writes failed during the import: {failures[0].message}")
+        return unwritten
+
+    # Listings
+
+    @staticmethod
+    def _iter_query(query, order_fields, cursor, limit):
+        for field in order_fields:
+            query = query.order_by(field)
+        if cursor:
+            query = query.start_after(cursor)
+        if limit:
+            query = query.limit(limit)
+        return (doc.to_dict() for doc in query.stream())
+
+    def iter_rooms(self, cursor=None, limit=None):
+        return self._iter_query(self.client.collection('rooms'), ['name'], cursor, limit)
+
+    def iter_user_bookings(self, user_id, room_name=None, cursor=None, limit=None):
+        # Read from the user's projection
+        query = self.client.collection('users').document(user_id).collection('user_bookings')
+        if room_name is not None:
+            query = query.where(filter=FieldFilter('room_name', '==', room_name))
+        return self._iter_query(query, BOOKING_ORDER, cursor, limit)
+
+    def iter_bookings_on_date(self, date, cursor=None, limit=None):
+        # A single collection group query over every room's bookings
+        query = self.client.collection_group('bookings').where(filter=FieldFilter('date', '==', date))
+        return self._iter_query(query, DATE_BOOKING_ORDER, cursor, limit)
+
+    def iter_bookings_in_range(self, start, end, room_name=None, cursor=None, limit=None):
+        # A single collection group range query on starts_at, whatever the number of days
+        query = (self.client.collection_group('bookings')
+                 .where(filter=FieldFilter('starts_at', '>=', start))
+                 .where(filter=FieldFilter('starts_at', '<', end)))
+        if room_name is not None:
+            query = query.where(filter=FieldFilter('room_name', '==', room_name))
+        return self._iter_query(query, RANGE_BOOKING_ORDER, range_cursor(cursor), limit)
+
+    # Users
+
+    def ensure_user(self, user_id):
+        user_ref = self.client.collection('users').document(user_id)
+        user = user_ref.get()
+        if user.exists:
+            return user.to_dict()
+
+        user_data = {
+            'name': 'John Doe',
+            'address_list': []
+        }
+        user_ref.set(user_data)
+        return user_data
+
+    # Change events
+
+    def watch(self, callback):
+        def forward(kind):
+            def on_snapshot(snapshots, changes, read_time):
+                for change in changes:
+                    callback({'type': f"{kind}_{change.type.name.lower()}", 'data': change.document.to_dict()})
+            return on_snapshot
+
+        # The bookings collection group leaves out the users' projections, which live in user_bookings
+        watches = [self.client.collection('rooms').on_snapshot(forward('room')),
+                   self.client.collection_group('bookings').on_snapshot(forward('booking'))]
+        return lambda: [watch.unsubscribe() for watch in watches]
+
+    # Maintenance
+
+    def migrate_booking_timestamps(self):
+        """
+        One-time migration adding starts_at and ends_at to bookings and their
+        per-user projections stored with string dates and times only.
+        Returns the number of documents updated.
+        """
+        migrated = 0
+        bulk_writer = self.client.bulk_writer()
+
+        for collection in ('bookings', 'user_bookings'):
+            for booking_doc in self.client.collection_group(collection).stream():
+                booking_data = booking_doc.to_dict()
+                if 'starts_at' in booking_data:
+                    continue
+
+                try:
+                    start_time, end_time = normalize_booking_times(booking_data.get('start_time', ''), booking_data.get('end_time', ''))
+                    starts_at, ends_at = booking_timestamps(booking_data.get('date', ''), start_time, end_time)
+                except ValueError:
+                    log_event(logging.WARNING, "migration_skipped_booking", path=booking_doc.reference.path, reason="invalid date or times")
+                    continue
+
+                bulk_writer.update(booking_doc.reference, {'start_time': start_time, 'end_time': end_time,
+                                                           'starts_at': starts_at, 'ends_at': ends_at})
+                migrated += 1
+
+        bulk_writer.close()
+        return migrated
+
+    def backfill_booking_projections(self):
+        """
+        One-time backfill of the booking index, the per-user booking projections,
+        the days' booked intervals, the day and room booking counts and the
+        dashboard for bookings created before they existed.
+        Returns the number of bookings written.
+        """
+        written = 0
+        batch = self.client.batch()
+        pending = 0
+
+        def queue_write(reference, data):
+            nonlocal batch, pending
+            batch.set(reference, data, merge=True)
+            pending += 1
+
+            # Firestore batches hold at most 500 writes
+            if pending == 500:
+                batch.commit()
+                batch = self.client.batch()
+                pending = 0
+
+        dashboard = {'rooms': {}, 'dates': {}}
+
+        for room_doc in self.client.collection('rooms').stream():
+            room_booking_count = 0
+
+            for day_doc in room_doc.reference.collection('days').stream():
+                intervals = []
+                day_booking_count = 0
+
+                for booking_doc in day_doc.reference.collection('bookings').stream():
+                    booking_data = booking_doc.to_dict()
+                    day_booking_count += 1
+
+                    booking_id = booking_data.get('id')
+                    if not booking_id:
+                        continue
+
+                    index_entry = self._index_entry(room_doc.id, day_doc.id, booking_data.get('booked_by'))
+                    if booking_doc.id != booking_id:
+                        index_entry['booking_doc_id'] = booking_doc.id
+                    queue_write(self._index_ref(booking_id), index_entry)
+
+                    if booking_data.get('booked_by'):
+                        queue_write(self._user_booking_ref(booking_data['booked_by'], booking_id), booking_data)
+
+                    try:
+                        start_time, end_time = normalize_booking_times(booking_data.get('start_time', ''), booking_data.get('end_time', ''))
+                        # Double bookings made before the check existed are kept, but reported
+                        overlap = find_conflicting_interval(intervals, start_time, end_time)
+                        if overlap:
+                            log_event(logging.WARNING, "backfill_overlapping_bookings", room=room_doc.id, date=day_doc.id,
+                                      booking_id=booking_id, overlaps=overlap['id'])
+                        insert_interval(intervals, start_time, end_time, booking_id)
+                    except ValueError:
+                        log_event(logging.WARNING, "backfill_skipped_interval", booking_id=booking_id, reason="invalid times")
+
+                    written += 1
+
+                queue_write(day_doc.reference, {'intervals': intervals, 'booking_count': day_booking_count})
+                room_booking_count += day_booking_count
+                dashboard['dates'][day_doc.id] = dashboard['dates'].get(day_doc.id, 0) + day_booking_count
+
+            queue_write(room_doc.reference, {'booking_count': room_booking_count})
+            dashboard['rooms'][room_doc.id] = {'user_id': room_doc.to_dict().get('user_id'), 'booking_count': room_booking_count}
+
+        if pending:
+            batch.commit()
+
+        # The dashboard is rebuilt from scratch rather than merged, and its counts shards start over
+        batch = self.client.batch()
+        batch.set(self._dashboard_ref(), dashboard)
+        for shard in range(DASHBOARD_COUNTER_SHARDS):
+            batch.delete(self._dashboard_counts_ref(shard))
+        batch.commit()
+
+        return written
+
+
+class InMemoryRepository(BookingRepository):
+    """
+    Keeps everything in process memory, for local runs, tests and benchmarks.
+    Lookups go through the same kind of indexes the Firestore layout has: bookings
+    by id, a sorted per-user index, a sorted per-date index and the sorted interval
+    list of every day. One lock makes every operation atomic.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.rooms = {}
+        self.room_names = []
+        self.days = {}
+        self.room_dates = {}
+        self.date_counts = {}
+        self.bookings = {}
+        self.user_index = {}
+        self.date_index = {}
+        self.time_index = []
+        self.archived_rooms = {}
+        self.room_removals = {}
+        self.users = {}
+        self.listeners = []
+
+    def _notify(self, event_type, data):
+        for listener in list(self.listeners):
+            listener({'type': event_type, 'data': dict(data)})
+
+    @staticmethod
+    def _user_key(booking):
+        return tuple(booking[field] for field in BOOKING_ORDER)
+
+    @staticmethod
+    def _date_key(booking):
+        return tuple(booking[field] for field in DATE_BOOKING_ORDER)
+
+    @staticmethod
+    def _time_key(booking):
+        return tuple(booking[field] for field in RANGE_BOOKING_ORDER)
+
+    def _add_booking(self, room_name, booking):
+        # Store the booking and add it to the indexes and counters; the interval is the caller's
+        date = booking['date']
+        day = self.days.setdefault((room_name, date), {'date': date, 'intervals': [], 'booking_count': 0})
+        day['booking_count'] += 1
+        self.room_dates.setdefault(room_name, set()).add(date)
+        self.date_counts[date] = self.date_counts.get(date, 0) + 1
+        self.rooms[room_name]['booking_count'] += 1
+
+        self.bookings[booking['id']] = booking
+        bisect.insort(self.user_index.setdefault(booking['booked_by'], []), self._user_key(booking))
+        bisect.insort(self.date_index.setdefault(date, []), self._date_key(booking))
+        bisect.insort(self.time_index, self._time_key(booking))
+
+    def _remove_booking(self, booking):
+        # Drop the booking from the indexes and counters, freeing its slot
+        day = self.days[(booking['room_name'], booking['date'])]
+        remove_interval(day['intervals'], booking['id'])
+        day['booking_count'] -= 1
+        self.date_counts[booking['date']] -= 1
+        if booking['room_name'] in self.rooms:
+            self.rooms[booking['room_name']]['booking_count'] -= 1
+
+        del self.bookings[booking['id']]
+        self.user_index[booking['booked_by']].remove(self._user_key(booking))
+        self.date_index[booking['date']].remove(self._date_key(booking))
+        self.time_index.remove(self._time_key(booking))
+
+    # Rooms
+
+    def list_rooms(self):
+        with self._lock:
+            return [dict(self.rooms[name]) for name in self.room_names]
+
+    def get_dashboard(self):
+        with self._lock:
+            return {'rooms': [{'name': name, 'user_id': self.rooms[name]['user_id'], 'booking_count': self.rooms[name]['booking_count']}
+                              for name in self.room_names],
+                    'dates': sorted(date for date, count in self.date_counts.items() if count > 0)}
+
+    def get_room(self, name):
+        with self._lock:
+            room = self.rooms.get(name)
+            return dict(room) if room else None
+
+    def create_room(self, user_id, name):
+        room = {
+            'name': name,
+            'days': [],
+            "user_id": user_id,
+            'booking_count': 0
+        }
+        with self._lock:
+            if name in self.rooms:
+                raise ValueError(f"Room '{name}' already exists")
+            bisect.insort(self.room_names, name)
+            self.rooms[name] = room
+            self._notify('room_added', room)
+        return dict(room)
+
+    def delete_room(self, name):
+        with self._lock:
+            room = self.rooms.get(name)
+            if room is None:
+                return
+            if self.room_has_bookings(name, room):
+                raise ValueError(f"Room '{name}' has bookings")
+            self._drop_room(name)
+
+    def _drop_room(self, name):
+        room = self.rooms.pop(name)
+        self.room_names.remove(name)
+        self._notify('room_removed', room)
+
+    def start_room_removal(self, name, archive=False):
+        with self._lock:
+            if name in self.room_removals:
+                raise ValueError(f"Room '{name}' is already being removed")
+            if name not in self.rooms:
+                raise ValueError(f"Room '{name}' does not exist")
+            lease = secrets.token_hex(8)
+            self.room_removals[name] = {'lease': lease, 'archive': archive}
+            return lease
+
+    def remove_room(self, name, lease, progress=None):
+        with self._lock:
+            # Removals run under the lock in one go, so the claim only has to keep a second run from starting
+            claim = self.room_removals.get(name)
+            if claim is None or claim['lease'] != lease:
+                raise RuntimeError(f"The removal of room '{name}' was taken over by another run")
+            del self.room_removals[name]
+            archive = claim['archive']
+
+            room = self.rooms.get(name)
+            if room is None:
+                return 0
+
+            bookings = [booking for booking in self.bookings.values() if booking['room_name'] == name]
+            if archive:
+                self.archived_rooms[name] = {'room': dict(room), 'bookings': [dict(booking) for booking in bookings]}
+
+            for booking in bookings:
+                self._remove_booking(booking)
+                self._notify('booking_removed', booking)
+            for date in self.room_dates.pop(name, ()):
+                del self.days[(name, date)]
+            self._drop_room(name)
+
+        if progress:
+            progress(len(bookings), len(bookings))
+        return len(bookings)
+
+    def resolve_rooms(self, room_names):
+        with self._lock:
+            return {name: name for name in room_names if name in self.rooms}
+
+    # Bookings
+
+    def create_booking(self, room_name, date, booking_info):
+        with self._lock:
+            if room_name not in self.rooms:
+                raise ValueError(f"Room '{room_name}' does not exist")
+            if booking_info['id'] in self.bookings:
+                return None
+
+            intervals = self.days.get((room_name, date), {}).get('intervals', [])
+            conflict = find_conflicting_interval(intervals, booking_info['start_time'], booking_info['end_time'])
+            if conflict:
+                return dict(conflict)
+
+            booking = add_timestamps(dict(booking_info, room_name=room_name, date=date))
+            self._add_booking(room_name, booking)
+            insert_interval(self.days[(room_name, date)]['intervals'], booking['start_time'], booking['end_time'], booking['id'])
+            self._notify('booking_added', booking)
+            return None
+
+    def get_booking(self, booking_id):
+        with self._lock:
+            booking = self.bookings.get(booking_id)
+            return dict(booking) if booking else None
+
+    def update_booking(self, booking_id, date, start_time, end_time):
+        with self._lock:
+            booking = self.bookings.get(booking_id)
+            if booking is None:
+                return None, None
+
+            # Check the new slot with the booking's own interval left out
+            intervals = [interval for interval in self.days.get((booking['room_name'], date), {}).get('intervals', [])
+                         if interval['id'] != booking_id]
+            conflict = find_conflicting_interval(intervals, start_time, end_time)
+            if conflict:
+                return dict(booking), dict(conflict)
+
+            # Build the moved booking first, so an invalid date leaves the old one in place
+            updated = add_timestamps(dict(booking, date=date, start_time=start_time, end_time=end_time))
+            self._remove_booking(booking)
+            booking = updated
+            self._add_booking(booking['room_name'], booking)
+            insert_interval(self.days[(booking['room_name'], date)]['intervals'], start_time, end_time, booking_id)
+            self._notify('booking_modified', booking)
+            return dict(booking), None
+
+    def delete_booking(self, booking_id):
+        with self._lock:
+            booking = self.bookings.get(booking_id)
+            if booking is None:
+                return False
+            self._remove_booking(booking)
+            self._notify('booking_removed', booking)
+            return True
+
+    def get_bookings_for_room(self, room_name, user_id):
+        return list(self.iter_user_bookings(user_id, room_name=room_name))
+
+    def get_day_intervals(self, days, versions=None):
+        # create_bookings holds the lock from this read to the write, so days need no versions
+        with self._lock:
+            return {(room_id, date): [dict(interval) for interval in self.days.get((room_id, date), {}).get('intervals', [])]
+                    for room_id, date in days}
+
+    def create_bookings(self, bookings):
+        # Hold the lock from validation to write so the check cannot go stale
+        with self._lock:
+            return super().create_bookings(bookings)
+
+    def write_bookings(self, new_bookings_by_day, intervals_by_day, day_versions):
+        with self._lock:
+            for (room_id, date), day_bookings in new_bookings_by_day.items():
+                for booking in day_bookings:
+                    self._add_booking(room_id, dict(booking))
+                    self._notify('booking_added', booking)
+                self.days[(room_id, date)]['intervals'] = intervals_by_day[(room_id, date)]
+        return []
+
+    # Listings
+
+    def _iter_index(self, keys, cursor, order_fields, limit):
+        """
+        Slices a sorted index just past the cursor, LISTING_BATCH_SIZE rows at a time,
+        copying each batch out under the lock. Every batch starts just past the last
+        key returned, so a long listing neither holds the lock nor copies everything at once.
+        """
+        last_key = tuple(cursor[field] for field in order_fields) if cursor else None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = LISTING_BATCH_SIZE if remaining is None else min(remaining, LISTING_BATCH_SIZE)
+            with self._lock:
+                position = bisect.bisect_right(keys, last_key) if last_key is not None else 0
+                batch = keys[position:position + size]
+                # Keys copied out of an index may name bookings deleted since
+                rows = [dict(self.bookings[key[-1]]) for key in batch if key[-1] in self.bookings]
+            if not batch:
+                return
+            yield from rows
+            last_key = batch[-1]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def iter_rooms(self, cursor=None, limit=None):
+        with self._lock:
+            position = bisect.bisect_right(self.room_names, cursor['name']) if cursor else 0
+            end = position + limit if limit else len(self.room_names)
+            return iter([dict(self.rooms[name]) for name in self.room_names[position:end]])
+
+    def iter_user_bookings(self, user_id, room_name=None, cursor=None, limit=None):
+        with self._lock:
+            keys = self.user_index.get(user_id, [])
+            if room_name is not None:
+                keys = [key for key in keys if self.bookings[key[-1]]['room_name'] == room_name]
+            return self._iter_index(keys, cursor, BOOKING_ORDER, limit)
+
+    def iter_bookings_on_date(self, date, cursor=None, limit=None):
+        with self._lock:
+            return self._iter_index(self.date_index.get(date, []), cursor, DATE_BOOKING_ORDER, limit)
+
+    def iter_bookings_in_range(self, start, end, room_name=None, cursor=None, limit=None):
+        with self._lock:
+            # The time index is sorted by starts_at first, so the range is one contiguous slice
+            keys = self.time_index[bisect.bisect_left(self.time_index, (start,)):bisect.bisect_left(self.time_index, (end,))]
+            if room_name is not None:
+                keys = [key for key in keys if key[1] == room_name]
+            return self._iter_index(keys, range_cursor(cursor), RANGE_BOOKING_ORDER, limit)
+
+    # Users
+
+    def ensure_user(self, user_id):
+        with self._lock:
+            user = self.users.setdefault(user_id, {'name': 'John Doe', 'address_list': []})
+            return dict(user)
+
+    # Change events
+
+    def watch(self, callback):
+        # Listeners are called synchronously, under the lock, after every change
+        with self._lock:
+            for name in self.room_names:
+                callback({'type': 'room_added', 'data': dict(self.rooms[name])})
+            for booking in self.bookings.values():
+                callback({'type': 'booking_added', 'data': dict(booking)})
+            self.listeners.append(callback)
+        return lambda: self.listeners.remove(callback)
+
+
+def create_repository(backend=None):
+    """
+    Builds the storage backend named by `backend`, the BOOKINGS_STORAGE_BACKEND
+    environment variable or STORAGE_BACKEND, in that order: "firestore" or "memory".
+    """
+    backend = backend or os.environ.get("BOOKINGS_STORAGE_BACKEND", STORAGE_BACKEND)
+    if backend == "firestore":
+        return FirestoreRepository(project=os.environ.get("GOOGLE_CLOUD_PROJECT", FIRESTORE_PROJECT))
+    if backend == "memory":
+        return InMemoryRepository()
+    raise ValueError(f"Unknown storage backend: {backend!r}")
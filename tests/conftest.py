@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOOKINGS_STORAGE_BACKEND", "memory")
+
+from fastapi.testclient import TestClient
+
+import main
+from instrumentation import InstrumentedRepository
+from storage import InMemoryRepository
+
+USER = 'user-1'
+
+
+@pytest.fixture
+def repository():
+    return InMemoryRepository()
+
+
+@pytest.fixture
+def user_token():
+    # Handlers see whatever this dict holds as the verified token; tests may change its user_id
+    return {'user_id': USER}
+
+
+@pytest.fixture
+def client(repository, user_token):
+    # The app driven in-process against a fresh memory backend, with authentication stubbed out
+    previous = main.repository
+    main.repository = InstrumentedRepository(repository)
+    main.read_cache.invalidate()
+    main.fragment_cache.invalidate()
+    main.app.dependency_overrides[main.get_user_token] = lambda: user_token
+    main.app.dependency_overrides[main.require_user_token] = lambda: user_token
+
+    yield TestClient(main.app, cookies={'token': 'test'})
+
+    main.app.dependency_overrides.clear()
+    main.repository = previous
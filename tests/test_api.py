@@ -0,0 +1,170 @@
+import json
+from datetime import date, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from conftest import USER
+from local_constants import BULK_MAX_BOOKINGS
+
+FIRST_DATE = date(2030, 1, 1)
+
+# Every /api listing with the query parameters it needs
+LISTINGS = [
+    ('/api/rooms', {}),
+    ('/api/bookings', {}),
+    ('/api/rooms/room-1/bookings', {}),
+    ('/api/bookings/by-date', {'date': FIRST_DATE.isoformat()}),
+    ('/api/bookings/range', {'from': FIRST_DATE.isoformat(), 'to': (FIRST_DATE + timedelta(days=2)).isoformat()}),
+]
+
+# The order fields each listing's cursors hold; listings ordered alike accept each other's cursors
+ORDER_FIELDS = {
+    '/api/rooms': ['name'],
+    '/api/bookings': main.BOOKING_ORDER,
+    '/api/rooms/room-1/bookings': main.BOOKING_ORDER,
+    '/api/bookings/by-date': main.DATE_BOOKING_ORDER,
+    '/api/bookings/range': main.RANGE_BOOKING_ORDER,
+}
+
+
+@pytest.fixture
+def seeded(repository):
+    # Three rooms booked by two users over three days, with equal start times across rooms
+    for room_number in range(3):
+        repository.create_room(USER, f"room-{room_number}")
+    for day in range(3):
+        for room_number in range(3):
+            for slot in range(3):
+                repository.create_booking(f"room-{room_number}", (FIRST_DATE + timedelta(days=day)).isoformat(), {
+                    'id': f"b-{day}-{room_number}-{slot}",
+                    'start_time': f"{9 + slot:02d}:00",
+                    'end_time': f"{9 + slot:02d}:30",
+                    'booked_by': USER if slot != 1 else 'user-2'
+                })
+    return repository
+
+
+def row_key(row):
+    return row.get('id', row.get('name'))
+
+
+def read_pages(client, path, params, limit):
+    rows, cursor = [], None
+    while True:
+        response = client.get(path, params=dict(params, limit=limit, **({'cursor': cursor} if cursor else {})))
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page['items']) <= limit
+        rows.extend(page['items'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return rows
+
+
+@pytest.mark.parametrize('path, params', LISTINGS)
+def test_cursor_pages_cover_the_listing_once(client, seeded, path, params):
+    everything = client.get(path, params=dict(params, limit=200)).json()
+    assert everything['next_cursor'] is None
+    assert everything['items']
+
+    for limit in (1, 2, 4):
+        assert [row_key(row) for row in read_pages(client, path, params, limit)] == [row_key(row) for row in everything['items']]
+
+
+@pytest.mark.parametrize('path, params', LISTINGS)
+def test_ndjson_resumes_after_a_page_cursor(client, seeded, path, params):
+    everything = [row_key(row) for row in client.get(path, params=dict(params, limit=200)).json()['items']]
+    page = client.get(path, params=dict(params, limit=2)).json()
+
+    response = client.get(path, params=dict(params, format='ndjson', cursor=page['next_cursor']))
+
+    assert response.status_code == 200
+    assert [row_key(json.loads(line)) for line in response.text.splitlines()] == everything[2:]
+
+
+@pytest.mark.parametrize('path, params', LISTINGS)
+@pytest.mark.parametrize('format', ['json', 'ndjson'])
+def test_cursors_of_differently_ordered_listings_are_rejected(client, seeded, path, params, format):
+    for other_path, other_params in LISTINGS:
+        if ORDER_FIELDS[other_path] == ORDER_FIELDS[path]:
+            continue
+        cursor = client.get(other_path, params=dict(other_params, limit=1)).json()['next_cursor']
+
+        response = client.get(path, params=dict(params, cursor=cursor, format=format))
+
+        assert response.status_code == 400, other_path
+
+
+@pytest.mark.parametrize('cursor', ['not-a-cursor', main.encode_cursor(['2030-01-01']), main.encode_cursor({'name': 1}), ''])
+@pytest.mark.parametrize('path, params', LISTINGS)
+def test_malformed_cursors_are_rejected(client, seeded, path, params, cursor):
+    response = client.get(path, params=dict(params, cursor=cursor))
+    assert response.status_code == (200 if cursor == '' else 400)
+
+
+def test_range_cursor_without_a_zone_is_rejected(client, seeded):
+    cursor = main.encode_cursor({'starts_at': '2030-01-01T09:00:00', 'room_name': 'room-0', 'id': 'b-0-0-0'})
+    response = client.get('/api/bookings/range', params={'from': '2030-01-01', 'to': '2030-01-03', 'cursor': cursor})
+    assert response.status_code == 400
+
+
+# Recurrences
+
+@pytest.mark.parametrize('frequency, dates', [
+    ('daily', ['2030-01-30', '2030-01-31', '2030-02-01']),
+    ('weekly', ['2030-01-30', '2030-02-06', '2030-02-13']),
+])
+def test_recurrence_expands_from_the_first_date(frequency, dates):
+    bookings = main.expand_recurrence('room-0', '2030-01-30', '09:00', '10:00', frequency, 3)
+    assert [booking['date'] for booking in bookings] == dates
+
+
+def test_recurrence_takes_the_largest_allowed_count():
+    assert len(main.expand_recurrence('room-0', '2030-01-01', '09:00', '10:00', 'daily', BULK_MAX_BOOKINGS)) == BULK_MAX_BOOKINGS
+
+
+@pytest.mark.parametrize('date_value, frequency, count', [
+    ('2030-01-01', 'daily', 0),
+    ('2030-01-01', 'daily', BULK_MAX_BOOKINGS + 1),
+    ('2030-01-01', 'monthly', 3),
+    ('2030-13-01', 'daily', 3),
+    ('9999-12-25', 'weekly', 2),
+    ('9999-12-31', 'daily', 2),
+])
+def test_recurrence_bounds_are_rejected(date_value, frequency, count):
+    with pytest.raises(HTTPException) as error:
+        main.expand_recurrence('room-0', date_value, '09:00', '10:00', frequency, count)
+    assert error.value.status_code == 400
+
+
+def test_recurrence_may_end_on_the_last_supported_date():
+    bookings = main.expand_recurrence('room-0', '9999-12-30', '09:00', '10:00', 'daily', 2)
+    assert bookings[-1]['date'] == '9999-12-31'
+
+
+def test_bulk_recurrence_is_refused_whole_when_one_occurrence_overlaps(client, repository):
+    repository.create_room(USER, 'room-0')
+    repository.create_booking('room-0', '2030-01-08', {'id': 'taken', 'start_time': '09:30', 'end_time': '10:30', 'booked_by': 'user-2'})
+
+    response = client.post('/bookings/bulk', data={'room_name': 'room-0', 'date': '2030-01-01', 'start_time': '09:00',
+                                                   'end_time': '10:00', 'frequency': 'weekly', 'count': 3})
+
+    assert response.status_code == 409
+    assert [error['row'] for error in response.json()['errors']] == [1]
+    assert repository.get_room('room-0')['booking_count'] == 1
+
+
+# Free slots
+
+@pytest.mark.parametrize('intervals, duration, expected', [
+    ([], 60, [(480, 1080)]),
+    ([('09:00', '10:00'), ('10:00', '11:00')], 60, [(480, 540), (660, 1080)]),
+    ([('07:00', '09:00'), ('17:30', '19:00')], 30, [(540, 1050)]),
+    ([('09:00', '12:00'), ('10:00', '10:30')], 60, [(480, 540), (720, 1080)]),
+    ([('08:30', '09:00')], 45, [(540, 1080)]),
+])
+def test_free_windows_sweep_the_day(intervals, duration, expected):
+    day = [{'start': start, 'end': end, 'id': str(position)} for position, (start, end) in enumerate(intervals)]
+    assert main.find_free_windows(day, 480, 1080, duration) == expected
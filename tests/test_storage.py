@@ -0,0 +1,136 @@
+import pytest
+
+from storage import find_conflicting_interval, insert_interval, remove_interval
+
+
+def booking(booking_id, start_time, end_time, booked_by='user-1'):
+    return {'id': booking_id, 'start_time': start_time, 'end_time': end_time, 'booked_by': booked_by}
+
+
+def intervals_of(*slots):
+    intervals = []
+    for position, (start_time, end_time) in enumerate(slots):
+        insert_interval(intervals, start_time, end_time, f"b{position}")
+    return intervals
+
+
+# Interval checks
+
+@pytest.mark.parametrize('start_time, end_time', [('08:00', '09:00'), ('10:00', '11:00'), ('11:00', '12:00')])
+def test_touching_intervals_do_not_conflict(start_time, end_time):
+    intervals = intervals_of(('09:00', '10:00'), ('12:00', '13:00'))
+    assert find_conflicting_interval(intervals, start_time, end_time) is None
+
+
+@pytest.mark.parametrize('start_time, end_time, conflict_id', [
+    ('08:30', '09:30', 'b0'),
+    ('09:15', '09:45', 'b0'),
+    ('09:30', '12:30', 'b1'),
+    ('08:00', '14:00', 'b1'),
+])
+def test_overlapping_intervals_conflict(start_time, end_time, conflict_id):
+    intervals = intervals_of(('09:00', '10:00'), ('12:00', '13:00'))
+    assert find_conflicting_interval(intervals, start_time, end_time)['id'] == conflict_id
+
+
+def test_intervals_stay_sorted_by_start():
+    intervals = intervals_of(('12:00', '13:00'), ('08:00', '09:00'), ('10:00', '11:00'))
+    assert [interval['start'] for interval in intervals] == ['08:00', '10:00', '12:00']
+
+    remove_interval(intervals, 'b2')
+    assert [interval['id'] for interval in intervals] == ['b1', 'b0']
+
+
+def test_backfilled_overlaps_are_checked_against_the_latest_end():
+    # Double bookings from before the check existed: the long booking still covers 11:00
+    intervals = intervals_of(('09:00', '12:00'), ('10:00', '10:30'))
+
+    assert find_conflicting_interval(intervals, '11:00', '11:30')['id'] == 'b0'
+    assert find_conflicting_interval(intervals, '10:15', '10:45')['id'] == 'b0'
+    assert find_conflicting_interval(intervals, '12:00', '13:00') is None
+
+
+# Bookings
+
+def test_create_booking_rejects_an_overlap(repository):
+    repository.create_room('user-1', 'room-a')
+    assert repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00')) is None
+
+    conflict = repository.create_booking('room-a', '2030-01-01', booking('second', '09:30', '10:30'))
+
+    assert conflict['id'] == 'first'
+    assert repository.get_booking('second') is None
+    assert repository.get_room('room-a')['booking_count'] == 1
+
+
+def test_create_booking_twice_with_the_same_id_stores_it_once(repository):
+    repository.create_room('user-1', 'room-a')
+    repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00'))
+
+    assert repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00')) is None
+    assert repository.get_room('room-a')['booking_count'] == 1
+
+
+def test_conflicting_update_leaves_the_booking_unchanged(repository):
+    repository.create_room('user-1', 'room-a')
+    repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00'))
+    repository.create_booking('room-a', '2030-01-02', booking('second', '09:00', '10:00'))
+
+    booking_data, conflict = repository.update_booking('second', '2030-01-01', '09:30', '10:30')
+
+    assert conflict['id'] == 'first'
+    assert booking_data['date'] == '2030-01-02'
+    stored = repository.get_booking('second')
+    assert (stored['date'], stored['start_time'], stored['end_time']) == ('2030-01-02', '09:00', '10:00')
+    # Its own slot is still taken, and the slot it tried to move into is not freed
+    assert repository.get_day_intervals([('room-a', '2030-01-02')])[('room-a', '2030-01-02')][0]['id'] == 'second'
+    assert [interval['id'] for interval in repository.get_day_intervals([('room-a', '2030-01-01')])[('room-a', '2030-01-01')]] == ['first']
+
+
+def test_update_may_overlap_the_bookings_own_slot(repository):
+    repository.create_room('user-1', 'room-a')
+    repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00'))
+
+    booking_data, conflict = repository.update_booking('first', '2030-01-01', '09:30', '10:30')
+
+    assert conflict is None
+    assert (booking_data['start_time'], booking_data['end_time']) == ('09:30', '10:30')
+
+
+def test_create_bookings_rejects_overlaps_within_the_import(repository):
+    repository.create_room('user-1', 'room-a')
+    bookings = [dict(booking('first', '09:00', '10:00'), room_name='room-a', date='2030-01-01'),
+                dict(booking('second', '09:30', '11:00'), room_name='room-a', date='2030-01-01')]
+
+    errors = repository.create_bookings(bookings)
+
+    assert [error['row'] for error in errors] == [1]
+    assert repository.get_booking('first') is None
+
+
+# Rooms
+
+def test_delete_room_refuses_a_room_with_bookings(repository):
+    repository.create_room('user-1', 'room-a')
+    repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00'))
+
+    with pytest.raises(ValueError):
+        repository.delete_room('room-a')
+    assert repository.get_room('room-a') is not None
+
+    repository.delete_booking('first')
+    repository.delete_room('room-a')
+    assert repository.get_room('room-a') is None
+
+
+def test_room_removal_runs_once(repository):
+    repository.create_room('user-1', 'room-a')
+    repository.create_booking('room-a', '2030-01-01', booking('first', '09:00', '10:00'))
+
+    lease = repository.start_room_removal('room-a', archive=True)
+    with pytest.raises(ValueError):
+        repository.start_room_removal('room-a')
+
+    assert repository.remove_room('room-a', lease) == 1
+    assert repository.get_booking('first') is None
+    assert repository.get_dashboard() == {'rooms': [], 'dates': []}